@@ -0,0 +1,839 @@
+#!/usr/bin/env python
+"""A stand-in NetBox REST API for benchmarking nbcli.
+
+Serves synthetic devices, interfaces, IP addresses, prefixes, VLANs, racks,
+sites, tenants, circuits and their terminations under /api/ with NetBox's
+limit/offset pagination, the filters nbcli uses and bulk PATCH/DELETE on
+list endpoints.  Objects are generated from their id when asked for, so a
+million of them costs no memory; only changes made through the API are
+kept.
+
+    python bench/fakenetbox.py --size 100000 --page-size 1000 --latency 0.02
+
+Changes made through the API are recorded in /api/extras/object-changes/.
+GET /_stats returns request and byte counters per endpoint, POST /_reset
+throws away changes and counters (POST /_reset/stats only the counters),
+POST /_churn makes a batch of changes as if users had ({"endpoint":
+"dcim/devices", "updates": 10, "deletes": 2, "creates": 3}) and POST
+/_prune forgets all but the newest change-log entry.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import gzip
+import io
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+    range = xrange
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+CREATED = '2020-01-01'
+LAST_UPDATED = '2020-01-01T00:00:00.000000Z'
+ACTIVE = {'value': 1, 'label': 'Active'}
+INTERFACES = 8      # per device
+
+
+def now():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000000Z', time.gmtime())
+
+
+# =======================
+# Synthetic data
+#
+# Every table has size objects with ids 1..size.  An object is built from its
+# id by make(), and parse() maps a key (name, serial, address, ...) straight
+# back to the id, so lookups never have to scan.
+class Dataset(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.sites = max(1, size // 500)
+        self.racks = max(1, size // 40)
+        self.vlans = max(1, size // 10)
+        self.tenants = max(1, size // 1000)
+        self.circuits = max(1, size // 100)
+
+    def site(self, i):
+        return {'id': i, 'name': 'site%04d' % i, 'slug': 'site%04d' % i}
+
+    def device_name(self, i):
+        return 'dev%07d' % i
+
+    def device(self, i):
+        site = (i - 1) % self.sites + 1
+        rack = ((i - 1) // 40) % self.racks + 1
+        return {
+            'id': i,
+            'url': '/api/dcim/devices/%d/' % i,
+            'name': self.device_name(i),
+            'display_name': self.device_name(i),
+            'device_type': {'id': i % 20 + 1, 'model': 'model-%02d' % (i % 20),
+                            'manufacturer': {'id': 1, 'name': 'Acme'}},
+            'device_role': {'id': i % 5 + 1, 'name': 'role-%d' % (i % 5)},
+            'tenant': None,
+            'platform': None,
+            'serial': 'SN%07d' % i,
+            'asset_tag': 'AT%07d' % i,
+            'site': self.site(site),
+            'rack': {'id': rack, 'name': 'rack%05d' % rack},
+            'position': (i - 1) % 40 + 1,
+            'face': {'value': 0, 'label': 'Front'},
+            'status': ACTIVE,
+            'primary_ip': {'id': i, 'address': self.address(i)},
+            'primary_ip4': {'id': i, 'address': self.address(i)},
+            'primary_ip6': None,
+            'cluster': None,
+            'virtual_chassis': None,
+            'comments': '',
+            'tags': [],
+            'custom_fields': {'warranty': None, 'owner': 'ops'},
+            'config_context': {'ntp': ['10.0.0.1', '10.0.0.2'],
+                               'syslog': ['10.0.0.3'], 'snmp': 'public'},
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def interface(self, i):
+        device = (i - 1) // INTERFACES + 1
+        return {
+            'id': i,
+            'url': '/api/dcim/interfaces/%d/' % i,
+            'device': {'id': device,
+                       'url': '/api/dcim/devices/%d/' % device,
+                       'name': self.device_name(device),
+                       'display_name': self.device_name(device)},
+            'name': 'eth%d' % ((i - 1) % INTERFACES),
+            'type': {'value': '1000base-t', 'label': '1000BASE-T (1GE)'},
+            'enabled': True,
+            'lag': None,
+            'mtu': None,
+            'mac_address': '02:00:%02X:%02X:%02X:%02X' % (
+                device >> 16 & 255, device >> 8 & 255, device & 255,
+                (i - 1) % INTERFACES),
+            'mgmt_only': False,
+            'description': '',
+            'mode': None,
+            'untagged_vlan': None,
+            'tagged_vlans': [],
+            'cable': None,
+            'connection_status': None,
+            'tags': [],
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def interface_site(self, obj):
+        return self.site((obj['device']['id'] - 1) % self.sites + 1)['slug']
+
+    def device_interfaces(self, device):
+        """Return the interface ids of a device id, None if there is none."""
+        if device is None or not 1 <= device <= self.size:
+            return None
+        return list(range((device - 1) * INTERFACES + 1,
+                          device * INTERFACES + 1))
+
+    def site_interfaces(self, site):
+        """Return the interface ids of all devices at a site id."""
+        if site is None or not 1 <= site <= self.sites:
+            return None
+        return [id for device in range(site, self.size + 1, self.sites)
+                for id in self.device_interfaces(device)]
+
+    def prefix_net(self, i):
+        return '%d.%d.%d' % (10 + (i >> 16), (i >> 8) & 255, i & 255)
+
+    def address(self, i):
+        return '%s.%d/24' % (self.prefix_net((i - 1) // 250 + 1),
+                             (i - 1) % 250 + 1)
+
+    def ip(self, i):
+        return {
+            'id': i,
+            'url': '/api/ipam/ip-addresses/%d/' % i,
+            'family': 4,
+            'address': self.address(i),
+            'vrf': None,
+            'tenant': None,
+            'status': ACTIVE,
+            'role': None,
+            'interface': {'id': i, 'name': 'eth0',
+                          'device': {'id': i, 'name': self.device_name(i)}},
+            'nat_inside': None,
+            'nat_outside': None,
+            'description': '',
+            'tags': [],
+            'custom_fields': {},
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def prefix(self, i):
+        vlan = (i - 1) % self.vlans + 1
+        return {
+            'id': i,
+            'url': '/api/ipam/prefixes/%d/' % i,
+            'family': 4,
+            'prefix': self.prefix_net(i) + '.0/24',
+            'site': self.site((i - 1) % self.sites + 1),
+            'vrf': None,
+            'tenant': None,
+            'vlan': {'id': vlan, 'vid': (vlan - 1) % 4094 + 1,
+                     'name': 'vlan%06d' % vlan},
+            'status': ACTIVE,
+            'role': None,
+            'is_pool': False,
+            'description': 'prefix %d' % i,
+            'tags': [],
+            'custom_fields': {},
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def vlan(self, i):
+        return {
+            'id': i,
+            'url': '/api/ipam/vlans/%d/' % i,
+            'site': self.site((i - 1) % self.sites + 1),
+            'group': None,
+            'vid': (i - 1) % 4094 + 1,
+            'name': 'vlan%06d' % i,
+            'display_name': 'vlan%06d' % i,
+            'tenant': None,
+            'status': ACTIVE,
+            'role': None,
+            'description': 'vlan %d' % i,
+            'tags': [],
+            'custom_fields': {},
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def rack(self, i):
+        return {
+            'id': i,
+            'url': '/api/dcim/racks/%d/' % i,
+            'name': 'rack%05d' % i,
+            'display_name': 'rack%05d' % i,
+            'site': self.site((i - 1) % self.sites + 1),
+            'role': None,
+            'status': ACTIVE,
+            'u_height': 42,
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def tenant(self, i):
+        return {'id': i, 'url': '/api/tenancy/tenants/%d/' % i,
+                'name': 'tenant%04d' % i, 'slug': 'tenant%04d' % i,
+                'group': None, 'description': '', 'created': CREATED,
+                'last_updated': LAST_UPDATED}
+
+    def circuit(self, i):
+        return {
+            'id': i,
+            'url': '/api/circuits/circuits/%d/' % i,
+            'cid': 'CID%06d' % i,
+            'provider': {'id': i % 7 + 1, 'name': 'provider-%d' % (i % 7)},
+            'type': {'id': 1, 'name': 'Internet'},
+            'status': ACTIVE,
+            'tenant': None,
+            'commit_rate': 1000,
+            'description': 'circuit %d' % i,
+            'created': CREATED,
+            'last_updated': LAST_UPDATED,
+        }
+
+    def circuit_termination(self, i):
+        """Side A (odd ids) or Z of circuit (i + 1) // 2.
+
+        Each lands on the last interface of a device, at the device's site.
+        """
+        circuit = (i + 1) // 2
+        device = (i - 1) % self.size + 1
+        interface = device * INTERFACES
+        return {
+            'id': i,
+            'url': '/api/circuits/circuit-terminations/%d/' % i,
+            'circuit': {'id': circuit,
+                        'url': '/api/circuits/circuits/%d/' % circuit,
+                        'cid': 'CID%06d' % circuit},
+            'term_side': 'A' if i % 2 else 'Z',
+            'site': self.site((device - 1) % self.sites + 1),
+            'port_speed': 1000000,
+            'upstream_speed': None,
+            'xconnect_id': '',
+            'pp_info': '',
+            'description': '',
+            'cable': {'id': i, 'url': '/api/dcim/cables/%d/' % i,
+                      'label': ''},
+            'connected_endpoint': {
+                'id': interface,
+                'url': '/api/dcim/interfaces/%d/' % interface,
+                'device': {'id': device,
+                           'url': '/api/dcim/devices/%d/' % device,
+                           'name': self.device_name(device),
+                           'display_name': self.device_name(device)},
+                'name': 'eth%d' % (INTERFACES - 1),
+                'cable': i,
+            },
+            'connection_status': {'value': True, 'label': 'Connected'},
+        }
+
+
+def parse_number(pattern):
+    regex = re.compile(pattern)
+
+    def parse(value):
+        match = regex.match(value)
+        return int(match.group(1)) if match else None
+    return parse
+
+
+def parse_address(value):
+    match = re.match(r'^(\d+)\.(\d+)\.(\d+)\.(\d+)(/\d+)?$', value)
+    if not match:
+        return None
+    a, b, c, host = [int(part) for part in match.groups()[:4]]
+    if not 1 <= host <= 250:
+        return None
+    return ((((a - 10) << 16) | (b << 8) | c) - 1) * 250 + host
+
+
+def parse_prefix(value):
+    match = re.match(r'^(\d+)\.(\d+)\.(\d+)\.0/24$', value)
+    if not match:
+        return None
+    a, b, c = [int(part) for part in match.groups()]
+    return ((a - 10) << 16) | (b << 8) | c
+
+
+class Table(object):
+    """One API endpoint: generated objects plus changes made through the API.
+
+    keys maps a filter field to (parse, read, clean): parse turns a filter
+    value into the id (or list of ids) of the generated objects that have
+    it, read gets the field from an object (or a tuple of values that each
+    match) and clean normalizes filter values before comparing.
+    """
+
+    def __init__(self, size, make, keys, search):
+        self.size = size
+        self.make = make
+        self.keys = keys
+        self.search = search
+        self.initial_size = size
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.size = self.initial_size
+            self.changed = {}
+            self.deleted = set()
+            self.alive = None
+
+    def get(self, id):
+        if id in self.deleted or not 1 <= id <= self.size:
+            return None
+        return self.changed.get(id) or self.make(id)
+
+    def alive_ids(self):
+        if not self.deleted:
+            return range(1, self.size + 1)
+        if self.alive is None:
+            self.alive = [id for id in range(1, self.size + 1)
+                          if id not in self.deleted]
+        return self.alive
+
+    def match(self, field, values):
+        """Return the set of ids matching field=values, None to ignore it."""
+        if field in ('id', 'id__in'):
+            if field == 'id__in':
+                values = [v for value in values for v in value.split(',')]
+            ids = set(int(value) for value in values if value.isdigit())
+            return set(id for id in ids if self.get(id) is not None)
+        if field == 'last_updated__gte':
+            if min(values) <= LAST_UPDATED:
+                return None
+            return set(id for id, obj in self.changed.items()
+                       if obj.get('last_updated', '') >= min(values))
+        if field == 'q':
+            needle = values[0].lower()
+            return set(id for id in self.alive_ids()
+                       if needle in self.search(id).lower())
+        if field not in self.keys:
+            return None     # NetBox ignores filters it does not know
+        parse, read, clean = self.keys[field]
+        wanted = set(clean(value) for value in values)
+
+        def hit(obj):
+            found = read(obj)
+            if isinstance(found, tuple):
+                return any(value in wanted for value in found)
+            return found in wanted
+        ids = set()
+        for value in values:
+            found = parse(value)
+            if found is None:
+                continue
+            for id in found if isinstance(found, list) else [found]:
+                if id in self.changed:
+                    continue
+                obj = self.get(id)
+                if obj is not None and hit(obj):
+                    ids.add(id)
+        for id, obj in self.changed.items():
+            if id not in self.deleted and hit(obj):
+                ids.add(id)
+        return ids
+
+    def select(self, query):
+        """Return the ids matching every filter in query, in id order."""
+        selected = None
+        for field, values in query.items():
+            if field in ('limit', 'offset', 'brief', 'exclude', 'ordering'):
+                continue
+            ids = self.match(field, values)
+            if ids is None:
+                continue
+            selected = ids if selected is None else selected & ids
+        if selected is None:
+            return self.alive_ids()
+        return sorted(selected)
+
+    def update(self, rows):
+        """Apply a bulk PATCH, all or nothing.  Returns the objects or None."""
+        with self.lock:
+            objects = []
+            for row in rows:
+                obj = self.get(row.get('id'))
+                if obj is None:
+                    return None
+                obj = dict(obj)
+                obj.update(row)
+                obj['last_updated'] = now()
+                objects.append(obj)
+            for obj in objects:
+                self.changed[obj['id']] = obj
+            return objects
+
+    def delete(self, ids):
+        with self.lock:
+            if any(self.get(id) is None for id in ids):
+                return False
+            self.deleted.update(ids)
+            self.alive = None
+            return True
+
+    def create(self, count):
+        """Add count generated objects, returns their ids."""
+        with self.lock:
+            ids = list(range(self.size + 1, self.size + count + 1))
+            self.size += count
+            self.alive = None
+            return ids
+
+
+# =======================
+# Change log
+
+CONTENT_TYPES = {
+    'dcim/devices': 'dcim.device',
+    'dcim/interfaces': 'dcim.interface',
+    'ipam/ip-addresses': 'ipam.ipaddress',
+    'ipam/prefixes': 'ipam.prefix',
+    'ipam/vlans': 'ipam.vlan',
+    'dcim/racks': 'dcim.rack',
+    'dcim/sites': 'dcim.site',
+    'tenancy/tenants': 'tenancy.tenant',
+    'circuits/circuits': 'circuits.circuit',
+    'circuits/circuit-terminations': 'circuits.circuittermination',
+}
+
+ACTIONS = {'create': 'Created', 'update': 'Updated', 'delete': 'Deleted'}
+
+
+class Changelog(object):
+    """extras/object-changes: one entry per object changed, newest first."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.entries = []
+            self.next_id = 1
+        # a NetBox always has some history
+        self.add('dcim/sites', 'create', [1], CREATED + 'T00:00:00.000000Z')
+
+    def add(self, endpoint, action, ids, when=None):
+        when = when or now()
+        with self.lock:
+            for id in ids:
+                self.entries.append({
+                    'id': self.next_id,
+                    'time': when,
+                    'user_name': 'admin',
+                    'action': {'value': action, 'label': ACTIONS[action]},
+                    'changed_object_type': CONTENT_TYPES[endpoint],
+                    'changed_object_id': id,
+                    'changed_object': None if action == 'delete' else
+                    {'id': id, 'url': '/api/%s/%d/' % (endpoint, id)},
+                })
+                self.next_id += 1
+
+    def prune(self):
+        with self.lock:
+            self.entries = self.entries[-1:]
+
+    def select(self, query):
+        """Return the entries matching the filters in query, newest first."""
+        after = query.get('time_after', [''])[0]
+        before = query.get('time_before', [''])[0]
+        types = set(query.get('changed_object_type', []))
+        with self.lock:
+            entries = list(self.entries)
+        return [entry for entry in reversed(entries)
+                if entry['time'] >= after and
+                (not before or entry['time'] <= before) and
+                (not types or entry['changed_object_type'] in types)]
+
+
+# the fields NetBox returns for ?brief=1
+BRIEF = {
+    'dcim/devices': ('id', 'url', 'name', 'display_name'),
+    'ipam/ip-addresses': ('id', 'url', 'family', 'address'),
+    'ipam/prefixes': ('id', 'url', 'family', 'prefix'),
+    'ipam/vlans': ('id', 'url', 'vid', 'name', 'display_name'),
+    'dcim/racks': ('id', 'url', 'name', 'display_name'),
+    'dcim/sites': ('id', 'url', 'name', 'slug'),
+    'tenancy/tenants': ('id', 'url', 'name', 'slug'),
+    'circuits/circuits': ('id', 'url', 'cid'),
+    'circuits/circuit-terminations': ('id', 'url', 'circuit', 'term_side'),
+    'dcim/interfaces': ('id', 'url', 'device', 'name', 'cable'),
+}
+
+
+def shape(endpoint, obj, query):
+    """Apply ?brief=1 and ?exclude= to an object about to be sent."""
+    if obj is None:
+        return None
+    if query.get('brief', [''])[0] in ('1', 'true', 'True'):
+        return dict((field, obj.get(field)) for field in BRIEF[endpoint])
+    exclude = set(','.join(query.get('exclude', [])).split(','))
+    if exclude & set(obj):
+        obj = dict((field, value) for field, value in obj.items()
+                   if field not in exclude)
+    return obj
+
+
+def key(parse, name, clean=None):
+    return (parse, lambda obj: obj.get(name), clean or (lambda value: value))
+
+
+def build_tables(size):
+    data = Dataset(size)
+    # NetBox matches address= with a mask exactly, without one on the host
+    address = (parse_address, lambda obj: (obj['address'],
+                                           obj['address'].split('/')[0]),
+               lambda value: value)
+    device = parse_number(r'^dev(\d+)$')
+    site = parse_number(r'^site(\d+)$')
+
+    def same(value):
+        return value
+    return {
+        'dcim/devices': Table(size, data.device, {
+            'name': key(parse_number(r'^dev(\d+)$'), 'name'),
+            'serial': key(parse_number(r'^SN(\d+)$'), 'serial'),
+            'asset_tag': key(parse_number(r'^AT(\d+)$'), 'asset_tag'),
+        }, data.device_name),
+        'dcim/interfaces': Table(size * INTERFACES, data.interface, {
+            'device': (lambda value: data.device_interfaces(device(value)),
+                       lambda obj: obj['device']['name'], same),
+            'site': (lambda value: data.site_interfaces(site(value)),
+                     data.interface_site, same),
+        }, lambda i: data.device_name((i - 1) // INTERFACES + 1)),
+        'ipam/ip-addresses': Table(size, data.ip, {
+            'address': address,
+        }, data.address),
+        'ipam/prefixes': Table(size, data.prefix, {
+            'prefix': key(parse_prefix, 'prefix'),
+        }, lambda i: data.prefix_net(i) + '.0/24'),
+        'ipam/vlans': Table(data.vlans, data.vlan, {
+            'name': key(parse_number(r'^vlan(\d+)$'), 'name'),
+        }, lambda i: 'vlan%06d' % i),
+        'dcim/racks': Table(data.racks, data.rack, {
+            'name': key(parse_number(r'^rack(\d+)$'), 'name'),
+        }, lambda i: 'rack%05d' % i),
+        'dcim/sites': Table(data.sites, data.site, {
+            'name': key(parse_number(r'^site(\d+)$'), 'name'),
+        }, lambda i: 'site%04d' % i),
+        'tenancy/tenants': Table(data.tenants, data.tenant, {
+            'name': key(parse_number(r'^tenant(\d+)$'), 'name'),
+        }, lambda i: 'tenant%04d' % i),
+        'circuits/circuits': Table(data.circuits, data.circuit, {
+            'cid': key(parse_number(r'^CID(\d+)$'), 'cid'),
+        }, lambda i: 'CID%06d' % i),
+        'circuits/circuit-terminations': Table(
+            data.circuits * 2, data.circuit_termination, {
+                'circuit_id': (
+                    lambda value: [int(value) * 2 - 1, int(value) * 2]
+                    if value.isdigit() else None,
+                    lambda obj: str(obj['circuit']['id']), same),
+            }, lambda i: 'CID%06d' % ((i + 1) // 2)),
+    }
+
+
+# =======================
+# HTTP
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+
+    def add(self, endpoint, nbytes):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint,
+                                              {'requests': 0, 'bytes': 0})
+            stats['requests'] += 1
+            stats['bytes'] += nbytes
+
+    def report(self):
+        with self.lock:
+            endpoints = dict((k, dict(v)) for k, v in self.endpoints.items())
+        return {
+            'requests': sum(v['requests'] for v in endpoints.values()),
+            'bytes': sum(v['bytes'] for v in endpoints.values()),
+            'endpoints': endpoints,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # keep-alive, like a real server
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def route(self):
+        """Return (endpoint, id or None, query) for the request path."""
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] != 'api':
+            return None, None, None
+        endpoint = '/'.join(parts[1:3])
+        id = int(parts[3]) if len(parts) > 3 and parts[3].isdigit() else None
+        return endpoint, id, parse_qs(url.query)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def send(self, status, obj=None, endpoint=None):
+        data = b'' if obj is None else json.dumps(obj).encode('utf-8')
+        gzipped = (self.server.gzip and data and 'gzip' in
+                   (self.headers.get('Accept-Encoding') or ''))
+        if gzipped:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=5) as f:
+                f.write(data)
+            data = buf.getvalue()
+        if endpoint is not None:
+            self.server.stats.add(endpoint, len(data))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def pause(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_GET(self):
+        if self.path.startswith('/_stats'):
+            return self.send(200, self.server.stats.report())
+        endpoint, id, query = self.route()
+        if endpoint == 'extras/object-changes':
+            self.pause()
+            entries = self.server.changelog.select(query)
+            return self.send_page(endpoint, query, entries,
+                                  lambda entry: entry)
+        table = self.server.tables.get(endpoint)
+        if table is None:
+            return self.send(404, {'detail': 'Not found.'})
+        self.pause()
+        if id is not None:
+            obj = table.get(id)
+            if obj is None:
+                return self.send(404, {'detail': 'Not found.'}, endpoint)
+            return self.send(200, shape(endpoint, obj, query), endpoint)
+        self.send_page(endpoint, query, table.select(query),
+                       lambda id: shape(endpoint, table.get(id), query))
+
+    def send_page(self, endpoint, query, ids, render):
+        """Send the page of ids that limit and offset ask for."""
+        limit = int(query.get('limit', ['0'])[0] or 0)
+        if limit <= 0 or limit > self.server.page_size:
+            limit = self.server.page_size
+        offset = int(query.get('offset', ['0'])[0] or 0)
+        # xrange cannot be sliced
+        page = [ids[k] for k in range(offset, min(offset + limit, len(ids)))]
+        url = urlparse(self.path)
+        nxt = None
+        if offset + limit < len(ids):
+            nxt = 'http://%s:%d%s?%s' % (
+                self.server.server_address + (url.path, re.sub(
+                    r'(^|&)(limit|offset)=[^&]*', '', url.query).strip('&')))
+            nxt += '&limit=%d&offset=%d' % (limit, offset + limit)
+        self.send(200, {'count': len(ids), 'next': nxt, 'previous': None,
+                        'results': [render(i) for i in page]}, endpoint)
+
+    def do_PATCH(self):
+        endpoint, id, query = self.route()
+        table = self.server.tables.get(endpoint)
+        if table is None:
+            return self.send(404, {'detail': 'Not found.'})
+        self.pause()
+        if id is None and self.server.no_bulk:
+            self.body()     # read, or the connection cannot be reused
+            return self.send(405, {'detail': 'Method "PATCH" not allowed.'})
+        body = self.body()
+        rows = body if id is None else [dict(body, id=id)]
+        objects = table.update(rows)
+        if objects is None:
+            return self.send(400, {'detail': 'Unknown id.'}, endpoint)
+        self.server.changelog.add(endpoint, 'update',
+                                  [obj['id'] for obj in objects])
+        self.send(200, objects if id is None else objects[0], endpoint)
+
+    def do_DELETE(self):
+        endpoint, id, query = self.route()
+        table = self.server.tables.get(endpoint)
+        if table is None:
+            return self.send(404, {'detail': 'Not found.'})
+        self.pause()
+        if id is None and self.server.no_bulk:
+            self.body()     # read, or the connection cannot be reused
+            return self.send(405, {'detail': 'Method "DELETE" not allowed.'})
+        ids = [id] if id is not None else [row['id'] for row in self.body()]
+        if not table.delete(ids):
+            return self.send(404, {'detail': 'Not found.'}, endpoint)
+        self.server.changelog.add(endpoint, 'delete', ids)
+        self.send(204, None, endpoint)
+
+    def do_POST(self):
+        if self.path.startswith('/_reset/stats'):
+            self.server.stats.reset()
+            return self.send(204)
+        if self.path.startswith('/_reset'):
+            for table in self.server.tables.values():
+                table.reset()
+            self.server.changelog.reset()
+            self.server.stats.reset()
+            return self.send(204)
+        if self.path.startswith('/_churn'):
+            return self.send(200, self.churn(self.body()))
+        if self.path.startswith('/_prune'):
+            self.server.changelog.prune()
+            return self.send(204)
+        self.send(405, {'detail': 'Method not allowed.'})
+
+
+    def churn(self, spec):
+        """Update, delete and create objects of one table at random."""
+        endpoint = spec.get('endpoint', 'dcim/devices')
+        table = self.server.tables[endpoint]
+        rng = random.Random(spec.get('seed'))
+        alive = table.alive_ids()
+        picked = rng.sample(alive, min(len(alive), spec.get('updates', 0) +
+                                       spec.get('deletes', 0)))
+        deletes = picked[:spec.get('deletes', 0)]
+        updates = picked[len(deletes):]
+        objects = table.update([{'id': id, 'description': 'churned'}
+                                for id in updates]) or []
+        self.server.changelog.add(endpoint, 'update',
+                                  [obj['id'] for obj in objects])
+        table.delete(deletes)
+        self.server.changelog.add(endpoint, 'delete', deletes)
+        created = table.create(spec.get('creates', 0))
+        self.server.changelog.add(endpoint, 'create', created)
+        return {'updated': len(objects), 'deleted': len(deletes),
+                'created': len(created)}
+
+
+class FakeNetBox(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, size, page_size=1000, latency=0.0,
+                 gzip=False, verbose=False, no_bulk=False):
+        HTTPServer.__init__(self, address, Handler)
+        self.tables = build_tables(size)
+        self.page_size = page_size
+        self.latency = latency
+        self.gzip = gzip
+        self.verbose = verbose
+        self.no_bulk = no_bulk
+        self.stats = Stats()
+        self.changelog = Changelog()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake NetBox API server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int,
+                        help='0 picks a free port (default: %(default)s)')
+    parser.add_argument('--size', default=10000, type=int,
+                        help='devices, IPs and prefixes '
+                             '(default: %(default)s)')
+    parser.add_argument('--page-size', default=1000, type=int,
+                        help='MAX_PAGE_SIZE (default: %(default)s)')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='seconds added to every API request')
+    parser.add_argument('--gzip', action='store_true',
+                        help='gzip responses when the client accepts it')
+    parser.add_argument('--no-bulk', action='store_true',
+                        help='answer bulk PATCH and DELETE with 405, like '
+                             'NetBox before 2.10')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = FakeNetBox((args.host, args.port), args.size, args.page_size,
+                        args.latency, args.gzip, args.verbose, args.no_bulk)
+    # the benchmark runner reads the port from this line
+    print('listening on http://%s:%d' % server.server_address)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""Benchmark nbcli actions against a local fake NetBox.
+
+For every dataset size a bench/fakenetbox.py server is started and each
+action is run against it as a separate nbcli process.  For every run the
+wall time, the number of API requests, the bytes the server sent and the
+peak RSS of the nbcli process are recorded and written as JSON, so two
+versions can be compared:
+
+    python bench/run.py --sizes 10000,100000 -o new.json --compare old.json
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+NBCLI = os.path.join(HERE, '..', 'nbcli.py')
+FAKENETBOX = os.path.join(HERE, 'fakenetbox.py')
+
+# name, nbcli arguments; {file} is replaced by the input file of that name
+ACTIONS = [
+    ('dcim', ['-t', 'device', '-f', '{devices}']),
+    ('ipam', ['-t', 'ip', '-f', '{ips}']),
+    ('cereal', ['-t', 'serial', '-f', '{serials}']),
+    ('cerealsearch', ['-t', 'serial', '-a', 'locate', '-f', '{serials}']),
+    ('interface', ['-t', 'interface', '-f', '{interfaces}']),
+    ('interface_site', ['-t', 'interface', '--site', 'site0001']),
+    ('veelan', ['-t', 'vlan']),
+    ('change_name', ['-a', 'rename', '-f', '{renames}']),
+    ('querysearch', ['-q', 'dev000001']),
+    ('manifest', ['--manifest', '{manifest}']),
+]
+
+
+def write_inputs(directory, size, lines):
+    """Write the input files, half of each naming objects that exist."""
+    rng = random.Random(size)
+    present = [rng.randint(1, size) for _ in range(lines // 2)]
+    missing = range(size + 1, size + 1 + lines - len(present))
+
+    def address(i):
+        i = min(i, 250 * 65535)
+        net = (i - 1) // 250 + 1
+        return '%d.%d.%d.%d' % (10 + (net >> 16), (net >> 8) & 255,
+                                net & 255, (i - 1) % 250 + 1)
+
+    files = {
+        'devices': ['dev%07d' % i for i in present] +
+                   ['missing%07d' % i for i in missing],
+        'serials': ['SN%07d' % i for i in present] +
+                   ['XX%07d' % i for i in missing],
+        'ips': [address(i) for i in present] +
+               ['192.0.2.%d' % (i % 250 + 1) for i in missing],
+        'interfaces': ['dev%07d:eth%d' % (i, i % 10) for i in present] +
+                      ['missing%07d:eth0' % i for i in missing],
+        'renames': ['dev%07d\tdev%07d-new' % (i, i) for i in present],
+    }
+    paths = {}
+    for name, content in files.items():
+        paths[name] = os.path.join(directory, name + '.txt')
+        with open(paths[name], 'w') as f:
+            f.write('\n'.join(content) + '\n')
+    # the dcim, cereal, ipam and veelan checks above in a single run
+    paths['manifest'] = os.path.join(directory, 'manifest.json')
+    with open(paths['manifest'], 'w') as f:
+        json.dump({'checks': [
+            {'type': 'device', 'file': paths['devices']},
+            {'type': 'device', 'file': paths['devices'], 'reverse': True},
+            {'type': 'serial', 'file': paths['serials']},
+            {'type': 'ip', 'file': paths['ips']},
+            {'type': 'vlan'},
+        ]}, f, indent=2)
+    return paths
+
+
+def start_server(size, page_size, latency, gzip):
+    command = [sys.executable, FAKENETBOX, '--port', '0', '--size', str(size),
+               '--page-size', str(page_size), '--latency', str(latency)]
+    if gzip:
+        command.append('--gzip')
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = server.stdout.readline().decode('utf-8')
+    match = re.search(r'(http://\S+)', line)
+    if not match:
+        server.kill()
+        raise RuntimeError('fake NetBox did not start: %r' % line)
+    return server, match.group(1)
+
+
+def server_call(url, path, method='GET', body=None):
+    data = None
+    if method == 'POST':
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+    request = Request(url + path, data=data)
+    response = urlopen(request)
+    body = response.read()
+    return json.loads(body.decode('utf-8')) if body else None
+
+
+def churn(url, size, fraction):
+    """Update, delete and create fraction of the objects of the big tables."""
+    count = max(1, int(size * fraction))
+    for endpoint in ('dcim/devices', 'ipam/ip-addresses', 'ipam/prefixes'):
+        server_call(url, '/_churn', 'POST', {
+            'endpoint': endpoint, 'updates': count, 'deletes': count // 10,
+            'creates': count // 10, 'seed': size})
+
+
+def start_daemon(url, home):
+    """Start nbcli serve for url, return it once its socket is up."""
+    env = dict(os.environ, NETBOX_URL=url, NETBOX_TOKEN='benchmark',
+               HOME=home)
+    with open(os.devnull, 'w') as devnull:
+        daemon = subprocess.Popen([sys.executable, NBCLI, 'serve'], env=env,
+                                  stdout=devnull, stderr=devnull)
+    socket = os.path.join(home, '.cache', 'nbcli', 'serve.sock')
+    for _ in range(100):
+        if os.path.exists(socket):
+            return daemon
+        time.sleep(0.1)
+    daemon.kill()
+    raise RuntimeError('nbcli serve did not start')
+
+
+def run_action(url, home, args):
+    """Run nbcli once, return (seconds, exit code, peak RSS in KiB)."""
+    env = dict(os.environ, NETBOX_URL=url, NETBOX_TOKEN='benchmark',
+               HOME=home)
+    rss_file = os.path.join(home, 'rss')
+    command = [sys.executable, os.path.realpath(__file__), '--child',
+               rss_file, '--'] + args
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        code = subprocess.call(command, env=env, stdout=devnull,
+                               stderr=devnull, stdin=devnull)
+        elapsed = time.time() - start
+    try:
+        with open(rss_file) as f:
+            rss = int(f.read())
+    except (IOError, ValueError):
+        rss = None
+    return elapsed, code, rss
+
+
+def child(rss_file, args):
+    """Run nbcli in this process and record its peak RSS at exit."""
+    import atexit
+    import resource
+    import runpy
+
+    def record():
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            rss //= 1024    # bytes there, KiB on Linux
+        with open(rss_file, 'w') as f:
+            f.write(str(rss))
+    atexit.register(record)
+    sys.argv = [NBCLI] + args
+    runpy.run_path(NBCLI, run_name='__main__')
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=HERE,
+            stderr=open(os.devnull, 'w')).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = json.load(f)
+    before = dict(((r['size'], r['action']), r) for r in old['results'])
+    print('\ncompared with %s (%s)' % (filename, old.get('version')))
+    print('%-14s %9s %9s %9s %9s' % ('action', 'size', 'time', 'requests',
+                                     'rss'))
+    for r in results:
+        o = before.get((r['size'], r['action']))
+        if o is None:
+            continue
+
+        def ratio(key):
+            if not o.get(key) or r.get(key) is None:
+                return '-'
+            return '%.2fx' % (r[key] / o[key])
+        print('%-14s %9d %9s %9s %9s' % (r['action'], r['size'],
+                                         ratio('seconds'), ratio('requests'),
+                                         ratio('peak_rss_kb')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nbcli benchmarks')
+    parser.add_argument('--sizes', default='10000',
+                        help='comma separated dataset sizes '
+                             '(default: %(default)s)')
+    parser.add_argument('--actions', default=None,
+                        help='comma separated subset of: ' +
+                             ', '.join(name for name, args in ACTIONS))
+    parser.add_argument('--lines', default=1000, type=int,
+                        help='lines per input file (default: %(default)s)')
+    parser.add_argument('--page-size', default=1000, type=int)
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='seconds the server adds to each request')
+    parser.add_argument('--gzip', action='store_true',
+                        help='server gzips responses')
+    parser.add_argument('--warm', action='store_true',
+                        help='run each action twice, measure the cached run')
+    parser.add_argument('--churn', default=0.0, type=float,
+                        metavar='FRACTION',
+                        help='with --warm change this fraction of every '
+                             'table between the runs and measure a --refresh')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run nbcli serve and measure the runs it '
+                             'answers (each action runs once to warm it)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the results as JSON to this file')
+    parser.add_argument('--compare', default=None, metavar='JSON',
+                        help='print ratios against an earlier --output')
+    parser.add_argument('nbcli_args', nargs='*',
+                        help='extra arguments for every nbcli run')
+    if len(sys.argv) > 2 and sys.argv[1] == '--child':
+        return child(sys.argv[2], sys.argv[4:])
+    args = parser.parse_args()
+
+    actions = ACTIONS
+    if args.actions:
+        wanted = args.actions.split(',')
+        actions = [action for action in ACTIONS if action[0] in wanted]
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        server, url = start_server(size, args.page_size, args.latency,
+                                   args.gzip)
+        home = tempfile.mkdtemp(prefix='nbcli-bench-')
+        daemon = None
+        try:
+            inputs = write_inputs(home, size, args.lines)
+            if args.daemon:
+                daemon = start_daemon(url, home)
+            for name, action in actions:
+                nbcli_args = [arg.format(**inputs) for arg in action]
+                nbcli_args += args.nbcli_args
+                server_call(url, '/_reset', 'POST')
+                if not args.daemon:
+                    shutil.rmtree(os.path.join(home, '.cache'),
+                                  ignore_errors=True)
+                if args.warm or args.daemon:
+                    run_action(url, home, nbcli_args)
+                    server_call(url, '/_reset', 'POST')
+                    if args.churn:
+                        churn(url, size, args.churn)
+                        server_call(url, '/_reset/stats', 'POST')
+                        nbcli_args.append('--refresh')
+                else:
+                    nbcli_args.append('--no-cache')
+                seconds, code, rss = run_action(url, home, nbcli_args)
+                stats = server_call(url, '/_stats')
+                result = {
+                    'action': name,
+                    'size': size,
+                    'seconds': round(seconds, 3),
+                    'requests': stats['requests'],
+                    'bytes': stats['bytes'],
+                    'peak_rss_kb': rss,
+                    'exit': code,
+                }
+                results.append(result)
+                print('%-14s %9d %8.2fs %7d req %10d bytes %8s KiB%s' % (
+                    name, size, seconds, stats['requests'], stats['bytes'],
+                    rss, '' if code == 0 else '  exit %d' % code))
+                sys.stdout.flush()
+        finally:
+            if daemon is not None:
+                daemon.terminate()
+                daemon.wait()
+            server.kill()
+            shutil.rmtree(home, ignore_errors=True)
+
+    report = {
+        'version': version(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'settings': {'lines': args.lines, 'page_size': args.page_size,
+                     'latency': args.latency, 'gzip': args.gzip,
+                     'warm': args.warm, 'daemon': args.daemon,
+                     'nbcli_args': args.nbcli_args},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Startup time benchmark for nbcli.
+
+nbcli gets called thousands of times from shell loops, so the time it takes
+to start matters.  This runs it the way those loops do (--help and an
+argument error) and prints the median wall time of each.  It fails when a
+median is over --max-ms, or when loading nbcli already imports one of the
+modules that should wait until an action needs the API.
+
+    python bench/startup.py -n 50 --max-ms 150
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+NBCLI = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                     '..', 'nbcli.py')
+LAZY_MODULES = ['requests', 'multiprocessing', 'distutils']
+CASES = [
+    ('--help', ['--help']),
+    ('argument error', ['-a']),
+]
+
+CHECK_IMPORTS = """
+import runpy, sys
+runpy.run_path(%r, run_name='nbcli_startup')
+print(' '.join(name for name in %r if name in sys.modules))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_runs(command, runs):
+    """Return the wall time in ms of each of runs runs of command."""
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nbcli startup benchmark')
+    parser.add_argument('-n', '--runs', default=20, type=int,
+                        help='invocations per case (default: %(default)s)')
+    parser.add_argument('--max-ms', default=None, type=float,
+                        help='fail when a median is slower than this')
+    args = parser.parse_args()
+
+    failed = False
+    interpreter = median(time_runs([sys.executable, '-c', 'pass'], args.runs))
+    print('%-20s %8.1f ms' % ('bare interpreter', interpreter))
+    for name, case in CASES:
+        result = median(time_runs([sys.executable, NBCLI] + case, args.runs))
+        print('%-20s %8.1f ms' % (name, result))
+        if args.max_ms is not None and result > args.max_ms:
+            print('  slower than --max-ms %.1f' % args.max_ms)
+            failed = True
+
+    imported = subprocess.check_output(
+        [sys.executable, '-c', CHECK_IMPORTS % (NBCLI, LAZY_MODULES)])
+    imported = imported.decode('utf-8').split()
+    if imported:
+        print('imported at startup: %s' % ', '.join(imported))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
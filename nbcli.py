@@ -6,23 +6,103 @@ or not items in a file are also in NetBox.
 """
 
 from argparse import RawTextHelpFormatter
-from distutils.util import strtobool
 import argparse
+import array
+import atexit
+import binascii
+import bisect
+import collections
+import contextlib
 import csv
-import inspect
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import os
-import pynetbox
-# import requests
+import random
+import re
+import signal
+import socket
 import sys
+import tempfile
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 NETBOX = 'https://your.url.here'
+# NETBOX_URL and NETBOX_TOKEN override the line above and .token
+NETBOX = os.environ.get('NETBOX_URL', NETBOX)
+# more NetBoxes by name for --instance, YAML or JSON:
+#   emea: {url: https://netbox-emea.example.com, token: 0123...}
+INSTANCES_FILES = [os.environ['NBCLI_INSTANCES']] \
+    if os.environ.get('NBCLI_INSTANCES') else \
+    [os.path.dirname(os.path.realpath(__file__)) + '/instances' + extension
+     for extension in ('.yaml', '.yml', '.json')]
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nbcli')
+CACHE_TTL = 3600        # seconds before a snapshot is considered stale
+SNAPSHOT_FORMAT = 2     # bumped when snapshot files change, older are ignored
+SNAPSHOT_LEVEL = 6      # gzip level, 9 is several times slower for ~2%
+PAGE_SIZE = 1000        # NetBox MAX_PAGE_SIZE default
+WORKERS = 4             # concurrent page downloads
+MAX_WORKERS = 8         # hard limit on concurrent requests
+POOL_SIZE = 8           # keep-alive connections to NetBox
+HTTP_TIMEOUT = 60       # seconds to wait for a response
+CONNECT_TIMEOUT = 5
+RETRIES = 5             # retries of a request after a transient failure
+BACKOFF = 0.5           # first retry waits up to this long, doubling after
+BACKOFF_MAX = 30
+RETRY_STATUS = (429, 502, 503, 504)
+BATCH_SIZE = 100        # objects sent in one bulk write request
+LOOKUP_CHUNK = 50       # filter values sent in one lookup request
+REQUEST_COST = 200      # planner: one round trip costs about this many objects
+RUN_SIZE = 500000       # --external: lines sorted in memory at a time
+
+# parsed command line arguments, filled in by __main__
+arguments = {}
+
+
+class Arguments(dict):
+    """The parsed command line, with per-thread overrides for manifest checks.
+
+    Reads see the overrides of the current thread first, set with
+    arguments.local.values = {...}.
+    """
+
+    def __init__(self, values):
+        dict.__init__(self, values)
+        self.local = threading.local()
+
+    def __getitem__(self, key):
+        values = getattr(self.local, 'values', None)
+        if values is not None and key in values:
+            return values[key]
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        values = dict(self)
+        values.update(getattr(self.local, 'values', None) or {})
+        return repr(values)
+
+    __str__ = __repr__
 
 
 # =======================
 def lineno():
     """Return current line number for use in logger.debug."""
-    return str(inspect.currentframe().f_back.f_lineno).zfill(3)
+    if logger.disabled:
+        return ''
+    return str(sys._getframe(1).f_lineno).zfill(3)
 
 
 # =======================
@@ -35,12 +115,1126 @@ logger.disabled = True
 logger.debug(lineno() + ': ==== start of program ====')
 
 # ====================================================
-# get the API token and create NetBox connection
-path = os.path.dirname(os.path.realpath(__file__)) + '/.token'
-with open(path) as f:
-    secret = f.read().splitlines()
-token = str(secret[0]).strip()
-nb = pynetbox.api(NETBOX, token)
+# NetBox connection
+#
+# Nothing is read or imported until an action first talks to NetBox, so
+# --help, argument errors and cached answers start fast.  connect() fills in
+# these globals and the connection of the current Instance.
+requests = None
+connect_lock = threading.Lock()
+
+
+class Instance(object):
+    """One NetBox: its URL and token, connection, snapshots and memo.
+
+    The unnamed default is NETBOX with NETBOX_TOKEN or .token; named ones
+    come from INSTANCES_FILES.  Snapshots are kept per URL, so pointing
+    NETBOX_URL elsewhere never reads another NetBox's.
+    """
+
+    def __init__(self, name, url, token=None):
+        self.name = name
+        self.url = url
+        self.token = token
+        self.session = None
+        self.cache_dir = os.path.join(CACHE_DIR, 'instances', hashlib.sha1(
+            url.rstrip('/').encode('utf-8')).hexdigest()[:12])
+        self.memo = {}              # see once()
+        self.throttle_until = 0.0   # see backoff()
+        self.bulk_writes = None     # see bulk_write()
+
+
+default_instance = Instance(None, NETBOX)
+current = threading.local()     # current.instance, when not the default
+
+
+def instance():
+    """Return the Instance this thread talks to."""
+    return getattr(current, 'instance', None) or default_instance
+
+
+def use_instance(site):
+    current.instance = site
+
+
+@contextlib.contextmanager
+def using(site):
+    """Talk to the Instance site in this thread for the with block."""
+    previous = getattr(current, 'instance', None)
+    current.instance = site
+    try:
+        yield site
+    finally:
+        current.instance = previous
+
+
+def load_instances():
+    """Return {name: Instance} from the first of INSTANCES_FILES there is.
+
+    Raises ValueError for a file nbcli cannot use.
+    """
+    for filename in INSTANCES_FILES:
+        if os.path.exists(filename):
+            break
+    else:
+        raise ValueError('no NetBox instances configured, see %s' %
+                         INSTANCES_FILES[0])
+    data = read_config(filename)
+    if isinstance(data, dict) and isinstance(data.get('instances'), dict):
+        data = data['instances']
+    if not isinstance(data, dict) or not data:
+        raise ValueError('%s: expected instances by name' % filename)
+    instances = {}
+    for name, config in sorted(data.items()):
+        if not re.match(r'^[\w.-]+$', name) or name == 'all':
+            raise ValueError('%s: bad instance name %r' % (filename, name))
+        if not isinstance(config, dict) or not config.get('url') or \
+                not config.get('token'):
+            raise ValueError('%s: instance %s needs a url and a token' %
+                             (filename, name))
+        instances[name] = Instance(name, config['url'], config['token'])
+    return instances
+
+
+def connect():
+    """Read the API token and create the NetBox connection, once."""
+    global requests
+    site = instance()
+    with connect_lock:
+        if site.session is not None:
+            return
+        logger.debug(lineno() + ': connect() ' + site.url)
+        import requests as requests_module
+        # bound first: the except requests.* clauses around a failed
+        # connect() would otherwise hide its error behind an AttributeError
+        requests = requests_module
+        token = site.token or os.environ.get('NETBOX_TOKEN')
+        if not token:
+            path = os.path.dirname(os.path.realpath(__file__)) + '/.token'
+            with open(path) as f:
+                secret = f.read().splitlines()
+            token = str(secret[0]).strip()
+        new_session = requests.Session()
+        new_session.headers.update({'Authorization': 'Token ' + token,
+                                    'Accept': 'application/json',
+                                    'Accept-Encoding': 'gzip, deflate'})
+        tune_session(new_session, arguments.get('pool_size') or POOL_SIZE)
+        site.session = new_session
+
+
+def thread_pool(workers):
+    """Return a ThreadPool of workers threads.
+
+    They talk to the Instance of the thread that made the pool.
+    """
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(workers, use_instance, (instance(),))
+
+
+def worker_count(jobs):
+    """Return the threads for jobs tasks: --workers, at most MAX_WORKERS."""
+    return max(1, min(arguments.get('workers') or WORKERS, MAX_WORKERS,
+                      jobs))
+
+
+@contextlib.contextmanager
+def worker_pool(jobs):
+    """Yield a thread_pool of worker_count(jobs), terminated on the way out."""
+    pool = thread_pool(worker_count(jobs))
+    try:
+        yield pool
+    finally:
+        pool.terminate()
+
+
+# =======================
+# HTTP transport
+#
+# One keep-alive session per NetBox is shared by every request nbcli sends
+# to it.  Its connection pool blocks rather than opening more than
+# --pool-size connections.  Transient failures (connection errors, timeouts,
+# 429 and 50x from a load balancer) are retried with jittered exponential
+# backoff, honouring Retry-After.  A 429 or 503 also holds back every other
+# thread talking to that NetBox until it is ready again.
+def tune_session(session, pool_size=POOL_SIZE):
+    """Mount a keep-alive pool of pool_size connections on session."""
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=max(1, pool_size), pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+throttle_lock = threading.Lock()
+
+
+def retry_after(response):
+    """Return the seconds asked for by a Retry-After header, or 0."""
+    if response is None:
+        return 0
+    value = response.headers.get('Retry-After')
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        from email.utils import mktime_tz, parsedate_tz
+        date = parsedate_tz(value)
+        return max(0, mktime_tz(date) - time.time()) if date else 0
+
+
+def backoff(attempt, response, path):
+    """Sleep before retry number attempt (0 based) of a request to path."""
+    stats.retry(path)
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+    delay = max(delay, retry_after(response))
+    if response is not None and response.status_code in (429, 503):
+        site = instance()
+        with throttle_lock:
+            site.throttle_until = max(site.throttle_until,
+                                      time.time() + delay)
+    logger.debug(lineno() + ': retry ' + str(attempt + 1) + ' in ' +
+                 '%.2fs' % delay)
+    time.sleep(delay)
+
+
+# =======================
+# Instrumentation
+#
+# Every API request is recorded per endpoint: requests, pages, bytes on the
+# wire, retries, errors and latencies.  Timers split the run into fetching,
+# output and the processing in between.  --stats prints the report on stderr
+# when nbcli exits, --stats FILE writes it as JSON.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FETCH_TIMER = 'waiting on NetBox or cache'
+OUTPUT_TIMER = 'formatting and output'
+
+
+def endpoint_name(path):
+    """Return 'dcim/devices' for 'dcim/devices' and 'dcim/devices/12'."""
+    parts = path.strip('/').split('/')
+    return '/'.join(part for part in parts if not part.isdigit())
+
+
+def percentile(values, fraction):
+    """Return the fraction (0..1) percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def wire_bytes(response):
+    """Return the size of a response body as sent, still compressed."""
+    content = response.content      # reads the whole body
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return len(content)
+
+
+class Stats(object):
+    """Counters and timers for one run of nbcli."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.endpoints = {}
+        self.timers = collections.defaultdict(float)
+
+    def endpoint(self, path):
+        name = endpoint_name(path)
+        counters = self.endpoints.get(name)
+        if counters is None:
+            counters = self.endpoints.setdefault(name, {
+                'requests': 0, 'pages': 0, 'bytes': 0, 'retries': 0,
+                'errors': 0, 'cached': 0, 'latencies': []})
+        return counters
+
+    def request(self, path, seconds, nbytes, error=False):
+        with self.lock:
+            counters = self.endpoint(path)
+            counters['requests'] += 1
+            counters['bytes'] += nbytes
+            counters['errors'] += bool(error)
+            counters['latencies'].append(seconds)
+
+    def count(self, path, counter, n=1):
+        with self.lock:
+            self.endpoint(path)[counter] += n
+
+    def page(self, path):
+        self.count(path, 'pages')
+
+    def retry(self, path):
+        self.count(path, 'retries')
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] += seconds
+
+    @contextlib.contextmanager
+    def timing(self, name):
+        """Add the time spent in the with block to name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def timed(self, name, iterable):
+        """Yield from iterable, adding the time spent waiting on it to name."""
+        iterator = iter(iterable)
+        waited = 0.0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = next(iterator)
+                finally:
+                    waited += time.time() - start
+                yield item
+        except StopIteration:
+            return
+        finally:
+            self.add_time(name, waited)
+
+    def report(self):
+        """Return everything recorded as a JSON-friendly dict."""
+        with self.lock:
+            endpoints = {}
+            for name, counters in sorted(self.endpoints.items()):
+                latencies = sorted(counters['latencies'])
+                histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+                for latency in latencies:
+                    histogram[len([b for b in LATENCY_BUCKETS
+                                   if b < latency])] += 1
+                endpoint = dict((k, v) for k, v in counters.items()
+                                if k != 'latencies')
+                endpoint.update({
+                    'p50': percentile(latencies, 0.50),
+                    'p95': percentile(latencies, 0.95),
+                    'p99': percentile(latencies, 0.99),
+                    'histogram': [{'le': bound, 'count': count}
+                                  for bound, count in zip(
+                                      LATENCY_BUCKETS + (None,), histogram)],
+                })
+                endpoints[name] = endpoint
+            total = time.time() - self.start
+            timers = dict(self.timers)
+        timers['processing'] = max(0.0, total - sum(
+            timers.values()))
+        timers['total'] = total
+        return {'endpoints': endpoints, 'seconds': timers}
+
+    def print_report(self, out):
+        report = self.report()
+        out.write('\n%-28s %8s %6s %7s %6s %8s %10s %7s %7s %7s\n' % (
+            'ENDPOINT', 'REQUESTS', 'PAGES', 'RETRIES', 'ERRORS', 'CACHED',
+            'BYTES', 'P50', 'P95', 'P99'))
+        for name, e in sorted(report['endpoints'].items()):
+            out.write('%-28s %8d %6d %7d %6d %8d %10d %6.0fms %6.0fms '
+                      '%6.0fms\n' % (name, e['requests'], e['pages'],
+                                      e['retries'], e['errors'], e['cached'],
+                                      e['bytes'], e['p50'] * 1000,
+                                      e['p95'] * 1000, e['p99'] * 1000))
+        seconds = report['seconds']
+        out.write('\ntotal %.3fs' % seconds.pop('total'))
+        for name in sorted(seconds):
+            out.write(', %s %.3fs' % (name, seconds[name]))
+        out.write('\n')
+
+
+stats = Stats()
+
+
+def write_stats():
+    """Write the --stats report, called when nbcli exits."""
+    target = arguments.get('stats')
+    sys.stdout.flush()
+    if target == '-':
+        stats.print_report(sys.stderr)
+    elif target:
+        with open(target, 'w') as f:
+            json.dump(stats.report(), f, indent=2, sort_keys=True)
+
+
+# =======================
+class Record(object):
+    """Attribute access over a NetBox API object, like pynetbox's Record."""
+
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = values
+
+    def __getattr__(self, name):
+        try:
+            value = self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+        if isinstance(value, dict):
+            return Record(value)
+        return value
+
+    def __str__(self):
+        for key in ('name', 'display_name', 'display', 'label', 'address',
+                    'prefix', 'cid', 'model'):
+            value = self._values.get(key)
+            if value:
+                return '%s' % value
+        return ''
+
+    __repr__ = __str__
+
+
+# =======================
+# Projections
+#
+# Most listings print a handful of columns of tables whose objects carry
+# dozens of nested fields, custom fields and config contexts.  Given the
+# columns it needs, iter_all() asks NetBox for no more than that (?brief=1
+# when the brief representation has every column, otherwise ?exclude= of
+# the fields nbcli never reads) and yields compact tuple rows instead of
+# Records, nested objects already flattened to their display string.
+BRIEF_FIELDS = {
+    'dcim/devices': ('id', 'url', 'name', 'display_name'),
+    'ipam/ip-addresses': ('id', 'url', 'family', 'address'),
+    'ipam/prefixes': ('id', 'url', 'family', 'prefix'),
+    'ipam/vlans': ('id', 'url', 'vid', 'name', 'display_name'),
+    'dcim/racks': ('id', 'url', 'name', 'display_name'),
+    'dcim/sites': ('id', 'url', 'name', 'slug'),
+    'tenancy/tenants': ('id', 'url', 'name', 'slug'),
+    'circuits/circuits': ('id', 'url', 'cid'),
+    'dcim/interfaces': ('id', 'url', 'device', 'name', 'cable'),
+}
+
+EXCLUDE_FIELDS = {
+    'dcim/devices': 'config_context',
+}
+
+row_types = {}
+
+
+def listing_params(path, columns=None):
+    """Return the query parameters that fetch enough of path for columns."""
+    if columns is not None:
+        brief = BRIEF_FIELDS.get(path, ())
+        if all(column.split('.')[0] in brief for column in columns):
+            return {'brief': 1}
+    if path in EXCLUDE_FIELDS:
+        return {'exclude': EXCLUDE_FIELDS[path]}
+    return {}
+
+
+def row_type(columns):
+    """Return a tuple class with one attribute per column.
+
+    Dotted columns become underscored attributes, 'site.name' is site_name.
+    """
+    columns = tuple(columns)
+    cls = row_types.get(columns)
+    if cls is None:
+        cls = collections.namedtuple(
+            'Row', [column.replace('.', '_') for column in columns],
+            rename=True)
+        row_types[columns] = cls
+    return cls
+
+
+def project_value(obj, column):
+    """Return a dotted column of an API object, flattened for a row."""
+    for name in column.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(name)
+    if isinstance(obj, dict):
+        return '%s' % Record(obj)
+    if isinstance(obj, list):
+        return ['%s' % Record(item) if isinstance(item, dict) else item
+                for item in obj]
+    return obj
+
+
+def projector(columns):
+    """Return a function that turns an API object into a row of columns."""
+    if columns is None:
+        return Record
+    make = row_type(columns)._make
+    columns = tuple(columns)
+
+    def project(obj):
+        return make([project_value(obj, column) for column in columns])
+    return project
+
+
+# =======================
+# API fetching and the local snapshot cache
+#
+# Every listing goes through iter_all() which keeps one gzipped JSON-lines
+# snapshot per endpoint and projection in the Instance.cache_dir of its
+# NetBox, one object per line behind its id and a tab, with its metadata in
+# a .meta file beside it.  Stale snapshots are brought up to date by
+# replaying NetBox's change log since the snapshot was taken:
+# created and updated objects are fetched by id, deleted ones dropped.  Only
+# when the change log no longer reaches back that far (or cannot be read,
+# then objects with a newer last_updated are merged as long as nothing was
+# deleted) is the whole table downloaded again.
+def api_request(method, path, params=None, data=None):
+    """Send a request to an API path such as 'dcim/devices'.
+
+    Returns the decoded JSON (None for an empty body) and raises
+    requests.HTTPError for an error status.
+    """
+    connect()
+    site = instance()
+    url = '%s/api/%s/' % (site.url.rstrip('/'), path.strip('/'))
+    retries = arguments.get('retries', RETRIES)
+    timeout = (CONNECT_TIMEOUT, arguments.get('http_timeout') or HTTP_TIMEOUT)
+    for attempt in range(retries + 1):
+        wait = site.throttle_until - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        start = time.time()
+        try:
+            response = site.session.request(method, url, params=params,
+                                            json=data, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            stats.request(path, time.time() - start, 0, error=True)
+            if attempt == retries:
+                raise
+            response = None
+        else:
+            stats.request(path, time.time() - start, wire_bytes(response),
+                          error=response.status_code >= 400)
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                break
+        backoff(attempt, response, path)
+    response.raise_for_status()
+    if not response.content:
+        return None
+    return response.json()
+
+
+def api_get(path, params=None):
+    """GET an API path such as 'dcim/devices' and return the decoded JSON."""
+    return api_request('GET', path, params)
+
+
+def fetch_pages(path, params=None):
+    """Yield every object of a paginated listing in NetBox order.
+
+    The first page tells us the total count, the remaining pages are then
+    downloaded --workers at a time (never more than MAX_WORKERS).  Only a
+    small window of pages is ever held in memory, however slow the consumer.
+    """
+    query = dict(params or {})
+    query.setdefault('limit', PAGE_SIZE)
+    query['offset'] = 0
+    first = api_get(path, query)
+    stats.page(path)
+    for obj in first['results']:
+        yield obj
+    if not first.get('next') or not first['results']:
+        return
+    limit = len(first['results'])
+    offsets = range(limit, first['count'], limit)
+    workers = worker_count(len(offsets))
+
+    def get_page(offset):
+        page_query = dict(query, limit=limit, offset=offset)
+        results = api_get(path, page_query)['results']
+        stats.page(path)
+        return results
+
+    logger.debug(lineno() + ': ' + path + ': ' + str(len(offsets)) +
+                 ' more pages, ' + str(workers) + ' workers')
+    with worker_pool(len(offsets)) as pool:
+        offsets = iter(offsets)
+        pending = collections.deque(
+            pool.apply_async(get_page, (offset,))
+            for offset in itertools.islice(offsets, workers * 2))
+        while pending:
+            results = pending.popleft().get()
+            for offset in itertools.islice(offsets, 1):
+                pending.append(pool.apply_async(get_page, (offset,)))
+            for obj in results:
+                yield obj
+
+
+def fetch_count(path, params=None):
+    """Return the number of objects NetBox holds for a listing."""
+    query = dict(params or {})
+    query['limit'] = 1
+    return api_get(path, query)['count']
+
+
+def cache_path(path, params=None):
+    """Return the snapshot file of a listing, one per path and projection."""
+    name = path.strip('/').replace('/', '.')
+    for item in sorted((params or {}).items()):
+        name += '.%s-%s' % item
+    return os.path.join(instance().cache_dir, name + '.jsonl.gz')
+
+
+def load_snapshot_meta(path, params=None):
+    """Return the metadata of the local snapshot, or None."""
+    try:
+        with open(cache_path(path, params) + '.meta') as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('format') != SNAPSHOT_FORMAT:
+        return None
+    return meta
+
+
+def snapshot_is_fresh(path, params=None):
+    if arguments.get('no_cache') or arguments.get('refresh'):
+        return False
+    meta = load_snapshot_meta(path, params)
+    ttl = arguments.get('cache_ttl') or CACHE_TTL
+    return meta is not None and time.time() - meta.get('synced', 0) < ttl
+
+
+def read_snapshot_lines(path, params=None):
+    """Yield (id, line) for the local snapshot without decoding objects."""
+    with gzip.open(cache_path(path, params), 'rb') as f:
+        for line in f:
+            yield int(line[:line.index(b'\t')]), line
+
+
+def read_snapshot(path, params=None):
+    """Yield the objects of the local snapshot one at a time."""
+    count = 0
+    try:
+        for id, line in read_snapshot_lines(path, params):
+            count += 1
+            yield json.loads(line[line.index(b'\t') + 1:].decode('utf-8'))
+    finally:
+        stats.count(path, 'cached', count)
+
+
+def remove_stale_temps(directory):
+    """Remove the *.tmp files of writers that died more than a TTL ago.
+
+    A SIGPIPE from a closed pipe (nbcli | head) ends nbcli without running
+    abort(), so their half-written snapshots are swept up here.
+    """
+    ttl = arguments.get('cache_ttl') or CACHE_TTL
+    for name in os.listdir(directory):
+        if not name.endswith('.tmp'):
+            continue
+        filename = os.path.join(directory, name)
+        try:
+            if time.time() - os.path.getmtime(filename) > ttl:
+                os.remove(filename)
+        except OSError:
+            pass    # another nbcli got there first
+
+
+class SnapshotWriter(object):
+    """Write a new snapshot beside the old one and swap it in on commit()."""
+
+    def __init__(self, path, params=None):
+        directory = instance().cache_dir
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        remove_stale_temps(directory)
+        self.path = path
+        self.params = params or {}
+        self.filename = cache_path(path, params)
+        # a name of its own, two nbcli writing one snapshot do not collide
+        fd, self.temp = tempfile.mkstemp(
+            '.tmp', os.path.basename(self.filename) + '.', directory)
+        os.close(fd)
+        self.file = gzip.open(self.temp, 'wb', SNAPSHOT_LEVEL)
+        self.count = 0
+        self.cursor = ''
+        self.changelog = None   # newest change-log time the snapshot has
+
+    def write(self, obj):
+        self.file.write(('%d\t%s\n' % (obj['id'], json.dumps(obj))
+                         ).encode('utf-8'))
+        self.count += 1
+        self.cursor = max(self.cursor, obj.get('last_updated') or '')
+
+    def copy(self, line, meta):
+        """Write a line of the snapshot described by meta unchanged."""
+        self.file.write(line)
+        self.count += 1
+        self.cursor = max(self.cursor, meta.get('cursor') or '')
+
+    def commit(self):
+        self.file.close()
+        os.rename(self.temp, self.filename)
+        meta = {'format': SNAPSHOT_FORMAT,
+                'path': self.path, 'params': self.params,
+                'synced': time.time(),
+                'count': self.count, 'cursor': self.cursor,
+                'changelog': self.changelog}
+        with open(self.filename + '.meta.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.rename(self.filename + '.meta.tmp', self.filename + '.meta')
+        return meta
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp)
+
+
+def stream_to_snapshot(path, params, objects, changelog=None):
+    """Pass objects through while saving them as the new snapshot.
+
+    The snapshot is only replaced once objects is exhausted, so an
+    interrupted listing never leaves half a table behind.
+    """
+    writer = SnapshotWriter(path, params)
+    writer.changelog = changelog
+    try:
+        for obj in objects:
+            writer.write(obj)
+            yield obj
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+
+
+# NetBox content type of each endpoint, to read its part of the change log
+CHANGELOG_TYPES = {
+    'dcim/devices': 'dcim.device',
+    'dcim/interfaces': 'dcim.interface',
+    'dcim/racks': 'dcim.rack',
+    'dcim/sites': 'dcim.site',
+    'ipam/ip-addresses': 'ipam.ipaddress',
+    'ipam/prefixes': 'ipam.prefix',
+    'ipam/vlans': 'ipam.vlan',
+    'tenancy/tenants': 'tenancy.tenant',
+    'circuits/circuits': 'circuits.circuit',
+    'circuits/circuit-terminations': 'circuits.circuittermination',
+}
+
+
+def changelog_times():
+    """Return the (oldest, newest) time in NetBox's change log.
+
+    None when the change log is empty or the token may not read it.
+    """
+    try:
+        newest = api_get('extras/object-changes', {'limit': 1})
+        oldest = newest
+        if newest['count'] > 1:     # newest first, the oldest is last
+            oldest = api_get('extras/object-changes',
+                             {'limit': 1, 'offset': newest['count'] - 1})
+    except requests.HTTPError:
+        return None
+    if not newest['results'] or not oldest['results']:
+        return None
+    return oldest['results'][0]['time'], newest['results'][0]['time']
+
+
+def refresh_snapshot(path, params, meta):
+    """Bring a stale snapshot up to date, False if that takes a download."""
+    if meta.get('changelog') and path in CHANGELOG_TYPES:
+        times = changelog_times()
+        if times is not None:
+            return replay_changelog(path, params, meta, times)
+    return merge_updated(path, params, meta)
+
+
+def replay_changelog(path, params, meta, times):
+    """Apply the change log since the snapshot was taken to the snapshot.
+
+    times is changelog_times().  Returns False when the oldest entry NetBox
+    still keeps is newer than the snapshot: changes may have been pruned.
+    """
+    if times[0] > meta['changelog']:
+        logger.debug(lineno() + ': ' + path + ' change log starts at ' +
+                     times[0] + ', snapshot is from ' + meta['changelog'])
+        return False
+    changes = fetch_pages('extras/object-changes', {
+        'time_after': meta['changelog'],
+        'changed_object_type': CHANGELOG_TYPES[path]})
+    changed = set()
+    deleted = set()
+    # the last change of an object decides, the log comes newest first
+    for change in sorted(changes, key=lambda change: change['id']):
+        action = change['action']
+        if isinstance(action, dict):
+            action = action.get('value')
+        if action == 'delete':
+            changed.discard(change['changed_object_id'])
+            deleted.add(change['changed_object_id'])
+        else:
+            deleted.discard(change['changed_object_id'])
+            changed.add(change['changed_object_id'])
+    ids = sorted(changed)
+    fetched = {}
+    for i in range(0, len(ids), LOOKUP_CHUNK):
+        query = dict(params or {}, id__in=','.join(
+            str(id) for id in ids[i:i + LOOKUP_CHUNK]))
+        for obj in fetch_pages(path, query):
+            fetched[obj['id']] = obj
+    logger.debug(lineno() + ': ' + path + ' change log: ' +
+                 str(len(changed)) + ' changed, ' + str(len(deleted)) +
+                 ' deleted')
+    expected = fetch_count(path)
+    writer = SnapshotWriter(path, params)
+    writer.changelog = times[1]
+    for id, line in read_snapshot_lines(path, params):
+        if id in fetched:
+            writer.write(fetched.pop(id))
+        elif id not in deleted and id not in changed:
+            writer.copy(line, meta)
+        # else changed, but deleted again since
+    for id in sorted(fetched):      # created since the snapshot
+        writer.write(fetched[id])
+    if writer.count != expected:
+        writer.abort()
+        return False
+    writer.commit()
+    return True
+
+
+def merge_updated(path, params, meta):
+    """Merge objects changed since the snapshot cursor into the snapshot.
+
+    Returns False when objects were deleted in NetBox, which only a full
+    download can pick up, and for projections without last_updated.
+    """
+    if not meta.get('cursor'):
+        return False
+    changed = dict((obj['id'], obj) for obj in fetch_pages(
+        path, dict(params or {}, last_updated__gte=meta['cursor'])))
+    logger.debug(lineno() + ': ' + path + ' incremental: ' +
+                 str(len(changed)) + ' changed')
+    expected = fetch_count(path)
+    writer = SnapshotWriter(path, params)
+    for id, line in read_snapshot_lines(path, params):
+        if id in changed:
+            writer.write(changed.pop(id))
+        else:
+            writer.copy(line, meta)
+    for id in sorted(changed):      # created since the snapshot
+        writer.write(changed[id])
+    if writer.count != expected:
+        writer.abort()
+        return False
+    writer.commit()
+    return True
+
+
+def iter_objects(path, params, filters=None):
+    """Yield the decoded objects of a listing, using the snapshot cache.
+
+    --no-cache always downloads the whole table, --refresh forces the
+    snapshot to be brought up to date even when it is younger than
+    --cache-ttl.  filters such as {'site': ['ams1']} are applied by NetBox
+    and such listings are never cached.
+    """
+    if filters:
+        objects = fetch_pages(path, dict(params, **filters))
+    elif arguments.get('no_cache'):
+        objects = fetch_pages(path, params)
+    else:
+        meta = load_snapshot_meta(path, params)
+        if meta is not None and not snapshot_is_fresh(path, params):
+            with stats.timing(FETCH_TIMER):
+                if not refresh_snapshot(path, params, meta):
+                    meta = None
+        if meta is None:
+            times = None
+            if path in CHANGELOG_TYPES:
+                times = changelog_times()   # before, not after the download
+            objects = stream_to_snapshot(path, params,
+                                         fetch_pages(path, params),
+                                         times and times[1])
+        else:
+            objects = read_snapshot(path, params)
+    if arguments.get('stats'):
+        objects = stats.timed(FETCH_TIMER, objects)
+    for obj in objects:
+        yield obj
+
+
+def iter_all(path, columns=None, filters=None):
+    """Yield every object at an API path, see iter_objects().
+
+    Objects are Records, or rows of just columns when those are given (see
+    projector()).  They are yielded as they arrive, nothing is kept in
+    memory, except in a --manifest run or nbcli serve where every check
+    shares one copy of each whole table.
+    """
+    if shared() and not filters:
+        objects = (json.loads(line) for line in shared_table(path))
+    else:
+        objects = iter_objects(path, listing_params(path, columns), filters)
+    project = projector(columns)
+    for obj in objects:
+        yield project(obj)
+
+
+def fetch_all(path, columns=None, filters=None):
+    """Return every object at an API path as a list, see iter_all()."""
+    return list(iter_all(path, columns, filters))
+
+
+# =======================
+# Server-side filtered lookups
+#
+# When only a handful of keys from a file have to be checked it is much
+# cheaper to ask NetBox for them (name=a&name=b&...) than to pull the whole
+# table.  plan_lookup() compares the two with a rough cost model of round
+# trips plus objects transferred.
+def fetch_matching(path, field, keys, columns=None):
+    """Return the objects whose field equals one of keys.
+
+    Objects are Records, or rows of just columns when those are given.
+    """
+    keys = sorted(set(key for key in keys if key))
+    chunks = [keys[i:i + LOOKUP_CHUNK]
+              for i in range(0, len(keys), LOOKUP_CHUNK)]
+    if not chunks:
+        return []
+    params = listing_params(path, columns)
+    project = projector(columns)
+    if serving and field in LOCAL_MATCH and \
+            ('table', path) in instance().memo:
+        # the daemon answers from its copy of the table
+        lines = shared_table(path)
+        index = once(('match', path, field), lambda: field_index(lines,
+                                                                 field))
+        return [project(json.loads(lines[i]))
+                for key in keys for i in index.get(key, ())]
+
+    def lookup(chunk):
+        query = dict(params)
+        query[field] = chunk
+        return [project(obj) for obj in fetch_pages(path, query)]
+
+    if shared():
+        # checks asking for the same keys share the answer
+        fetch = lookup
+
+        def lookup(chunk):
+            return once(('lookup', path, field, tuple(chunk),
+                         tuple(columns or ())), lambda: fetch(chunk))
+
+    with worker_pool(len(chunks)) as pool, stats.timing(FETCH_TIMER):
+        results = pool.map(lookup, chunks)
+    return [obj for chunk in results for obj in chunk]
+
+
+def plan_lookup(path, nkeys, params=None):
+    """Return 'point' or 'scan' as the cheaper way to check nkeys keys."""
+    mode = arguments.get('lookup') or 'auto'
+    if mode != 'auto':
+        return mode
+    if serving:
+        return 'scan'   # the daemon keeps the table and its index warm
+    if snapshot_is_fresh(path, params):
+        return 'scan'   # the full table is already on disk
+    if arguments.get('manifest') and ('table', path) in instance().memo:
+        return 'scan'   # another check of the manifest is fetching it
+    count = fetch_count(path)
+    point = -(-nkeys // LOOKUP_CHUNK) * REQUEST_COST + min(nkeys, count)
+    scan = -(-count // PAGE_SIZE) * REQUEST_COST + count
+    logger.debug(lineno() + ': ' + path + ' plan: point=' + str(point) +
+                 ' scan=' + str(scan))
+    return 'point' if point < scan else 'scan'
+
+
+# =======================
+# In-process memo of related objects
+#
+# Listings that show a related object (the VLAN of a prefix, the site of a
+# rack, ...) join against these instead of asking NetBox once per row.
+# Everything is fetched at most once per run.  nbcli serve replaces the
+# whole memo when it refreshes its tables.  Every Instance has a memo of its
+# own.
+memo_lock = threading.Lock()
+serving = False         # set by nbcli serve
+LOCAL_MATCH = ('name', 'serial', 'asset_tag')   # fields serve looks up itself
+
+
+def shared():
+    """Return whether checks share whole tables: --manifest and serve."""
+    return serving or bool(arguments.get('manifest'))
+
+
+def related(path):
+    """Return {id: object} for the whole table at path, once per run."""
+    memo = instance().memo
+    with memo_lock:
+        table = memo.get(path)
+    if table is None:
+        table = dict((obj.id, obj) for obj in fetch_all(path))
+        with memo_lock:
+            table = memo.setdefault(path, table)
+    return table
+
+
+def once(key, make):
+    """Return make(), called at most once per run for key.
+
+    Threads asking for the same key while make() runs wait for its result.
+    Each Instance has its own keys.
+    """
+    memo = instance().memo
+    with memo_lock:
+        entry = memo.get(key)
+        if entry is None:
+            entry = memo[key] = {'lock': threading.Lock()}
+    with entry['lock']:
+        if 'value' not in entry:
+            entry['value'] = make()
+    return entry['value']
+
+
+def shared_table(path):
+    """Return the whole table at path as JSON lines, downloaded once.
+
+    JSON text takes a fraction of the memory of the decoded objects; every
+    user decodes and projects it again.
+    """
+    return once(('table', path), lambda: [
+        json.dumps(obj) for obj in iter_objects(path, listing_params(path))])
+
+
+def field_index(lines, field):
+    """Return {value: [line number]} of field over a shared_table()."""
+    index = {}
+    for number, line in enumerate(lines):
+        index.setdefault(json.loads(line).get(field), []).append(number)
+    return index
+
+
+# =======================
+# Bulk writes
+#
+# NetBox 2.10 and later accept a list of {'id': ..., ...} on the list
+# endpoint for PATCH and DELETE.  A batch is all or nothing, so when one
+# fails its rows are retried one by one to tell the good from the bad.
+# Older NetBox answers 405: the first batch is sent alone to find out, and
+# after a 405 every row goes to its own object.  Once NetBox cannot be
+# reached the rest is not sent, and reported as such.
+def http_error_text(error):
+    try:
+        return '%s %s' % (error.response.status_code,
+                          error.response.text[:200].strip())
+    except AttributeError:
+        return str(error)
+
+
+NOT_SENT = 'not sent, NetBox could not be reached'
+
+
+def bulk_write(method, path, rows):
+    """Send rows as batched bulk requests over the worker pool.
+
+    Returns (done, errors): the rows written and a list of (row, message).
+    """
+    size = max(1, arguments.get('batch_size') or BATCH_SIZE)
+    batches = [rows[i:i + size] for i in range(0, len(rows), size)]
+    site = instance()
+    unreachable = []    # the errors that cut NetBox off
+
+    def lost(error):
+        unreachable.append(error)
+        return 'NetBox unreachable, may not be written: %s' % error
+
+    def write(batch):
+        if unreachable:
+            return [], [(row, NOT_SENT) for row in batch]
+        if site.bulk_writes is not False:
+            try:
+                api_request(method, path, data=batch)
+                site.bulk_writes = True
+                return batch, []
+            except requests.HTTPError as error:
+                if getattr(error.response, 'status_code', None) == 405:
+                    site.bulk_writes = False    # NetBox before 2.10
+                elif len(batch) == 1:
+                    return [], [(batch[0], http_error_text(error))]
+            except (requests.ConnectionError, requests.Timeout) as error:
+                message = lost(error)
+                return [], [(row, message) for row in batch]
+        done, errors = [], []
+        for row in batch:
+            body = dict((k, v) for k, v in row.items() if k != 'id')
+            if unreachable:
+                errors.append((row, NOT_SENT))
+                continue
+            try:
+                api_request(method, '%s/%s' % (path, row['id']),
+                            data=body or None)
+                done.append(row)
+            except requests.HTTPError as error:
+                errors.append((row, http_error_text(error)))
+            except (requests.ConnectionError, requests.Timeout) as error:
+                errors.append((row, lost(error)))
+        return done, errors
+
+    done, errors = [], []
+    if not batches:
+        return done, errors
+    try:
+        if site.bulk_writes is None:
+            # alone, so that an old NetBox sees one bulk request, not one
+            # per worker
+            done, errors = write(batches.pop(0))
+        with worker_pool(len(batches)) as pool:
+            for batch_done, batch_errors in pool.imap(write, batches):
+                done.extend(batch_done)
+                errors.extend(batch_errors)
+    finally:
+        if done:
+            forget_table(path)
+    return done, errors
+
+
+# snapshots that copy fields of the objects at a path, besides its own
+EMBEDDED_IN = {'dcim/devices': ('dcim/interfaces',)}
+
+
+def forget_table(path):
+    """Make the next read of path see what was just written to it.
+
+    Its snapshots are marked stale, so the next listing brings them up to
+    date, and the ones that embed its objects (the device names of
+    interfaces) are dropped.  Its tables and indexes leave the memo.
+    """
+    site = instance()
+    paths = (path,) + EMBEDDED_IN.get(path, ())
+    try:
+        names = os.listdir(site.cache_dir)
+    except OSError:
+        names = []
+    for stale in paths:
+        prefix = stale.strip('/').replace('/', '.') + '.'
+        for name in names:
+            if not name.startswith(prefix) or \
+                    not name.endswith('.jsonl.gz.meta'):
+                continue
+            filename = os.path.join(site.cache_dir, name)
+            try:
+                if stale != path:
+                    raise ValueError('embedded')
+                with open(filename) as f:
+                    meta = json.load(f)
+                meta['synced'] = 0
+                with open(filename, 'w') as f:
+                    json.dump(meta, f)
+            except (IOError, OSError, ValueError):
+                try:
+                    os.remove(filename)     # downloaded again when needed
+                except OSError:
+                    pass
+    with memo_lock:
+        for key in list(site.memo):
+            if key in paths or isinstance(key, tuple) and (
+                    key[1:2] and key[1] in paths or key[0] == 'index' and
+                    RECONCILE[key[1]][0] in paths):
+                del site.memo[key]
 
 
 # =======================
@@ -60,24 +1254,158 @@ def ArgParse(argparser):
         '-q', '--query', default=None, type=str,
         help='General search in NetBox'
     )
+    argparser.add_argument(
+        '--timeout', default=None, type=float, metavar='SECONDS',
+        help='with -q give up on a section after SECONDS'
+    )
     argparser.add_argument(
         '-f', '--file', default=None,
-        help='file with one -t TYPE per line (do not include mask or FQDN)'
+        help='''file with one -t TYPE per line (FQDNs need --normalize fqdn)
+DEVICE:INTERFACE per line for -t interface'''
     )
     # -t TYPE
     argparser.add_argument(
         '-r', '--reverse', action='store_true',
         help='reverse search to list objects in NetBox',
         required=False)
+    argparser.add_argument(
+        '-d', '--diff', action='store_true',
+        help='''with -f show a three-way diff instead of a list:
+= in both, - only in the file, + only in NetBox''',
+        required=False)
     argparser.add_argument(
         '-hd', '--headers',
         action='store_true',
         help='show headers when listing',
         required=False)
+    argparser.add_argument(
+        '--tsv', action='store_true',
+        help='print listings as tab separated values, without padding',
+        required=False)
+    argparser.add_argument(
+        '--pager', action='store_true',
+        help='page the output through $PAGER (default: less -FRSX)',
+        required=False)
     argparser.add_argument(
         '-t', '--type', default='device',
-        help='device, ip, vlan, circuit, rack, prefix, interface',
+        help='device, ip, vlan, circuit, rack, prefix, interface, serial, '
+             'asset',
         required=False)
+    argparser.add_argument(
+        '--stats', nargs='?', const='-', default=None, metavar='FILE',
+        help='''report requests, bytes, retries and latency per endpoint
+and where the time went; on stderr, or as JSON to FILE''')
+    argparser.add_argument(
+        '--dry-run', action='store_true',
+        help='show what -a rename or -a delete would change, change nothing')
+    argparser.add_argument(
+        '--batch-size', default=BATCH_SIZE, type=int, metavar='N',
+        help='objects per bulk write request (default: %(default)s)')
+    argparser.add_argument(
+        '--lookup', default='auto', choices=['auto', 'scan', 'point'],
+        help='''how -f checks fetch from NetBox (default: %(default)s)
+scan: download the whole table, point: ask only for the keys in the file
+auto: pick the cheaper one for the file and table size''')
+
+    def rules(text):
+        try:
+            return normalize_rules(text)
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(str(error))
+    argparser.add_argument(
+        '--normalize', default=None, type=rules, metavar='RULES',
+        help='''with -f match names normalized on both sides, comma separated:
+case: ignore case, fqdn: drop the domain of device names,
+sep: ignore - _ . and blanks; all: all three''')
+    argparser.add_argument(
+        '--suggest', nargs='?', const=3, default=None, type=int, metavar='N',
+        help='with -f show up to N (default 3) similar NetBox names '
+             'for each line not found')
+    argparser.add_argument(
+        '--external', action='store_true',
+        help='''-f checks of files too big for memory: sort both sides on
+disk and merge them; results come in sorted order''')
+    argparser.add_argument(
+        '--run-size', default=RUN_SIZE, type=int, metavar='N',
+        help='--external: lines sorted in memory at a time '
+             '(default: %(default)s)')
+    argparser.add_argument(
+        '--workers', default=WORKERS, type=int, metavar='N',
+        help='pages to download at the same time '
+             '(max %d, default: %%(default)s)' % MAX_WORKERS)
+    argparser.add_argument(
+        '--manifest', default=None, metavar='FILE',
+        help='''run the checks listed in a YAML or JSON FILE together,
+fetching every table once; see the README''')
+    # several NetBox instances
+    argparser.add_argument(
+        '--instance', default=None, action='append', metavar='NAME',
+        help='''run against NetBox instance NAME of instances.yaml instead,
+repeatable or comma separated, all for every one; they run at the same
+time and the output of each comes under its name''')
+    argparser.add_argument(
+        '--match', default=None, choices=['any', 'which'],
+        help='''-f checks against several --instance as one:
+any: a line is in NetBox when it is in any of them
+which: list every line with the instances it is in''')
+    # nbcli serve
+    argparser.add_argument(
+        'command', nargs='?', default=None, choices=['serve'],
+        help='''serve: keep tables in memory and answer -q, list, locate
+and export of other nbcli runs over --socket''')
+    argparser.add_argument(
+        '--socket', default=SOCKET, metavar='PATH',
+        help='Unix socket of nbcli serve (default: %(default)s)')
+    argparser.add_argument(
+        '--no-daemon', action='store_true',
+        help='do not hand the work to a running nbcli serve')
+    argparser.add_argument(
+        '--refresh-interval', default=REFRESH_INTERVAL, type=int,
+        metavar='SECONDS',
+        help='nbcli serve: look for changes in NetBox this often '
+             '(default: %(default)s)')
+    # -t interface
+    argparser.add_argument(
+        '--device', default=None, action='append', metavar='NAME',
+        help='-t interface: only the interfaces of device NAME, repeatable')
+    argparser.add_argument(
+        '--site', default=None, action='append', metavar='SLUG',
+        help='-t interface: only the interfaces at site SLUG, repeatable')
+    # -a export
+    argparser.add_argument(
+        '--format', default='csv', choices=['csv', 'jsonl'],
+        help='-a export file format (default: %(default)s)')
+    argparser.add_argument(
+        '--columns', default=None, metavar='COL,COL',
+        help='''-a export columns, dotted for nested fields (site.name)
+default: a few per type for csv, the whole object for jsonl''')
+    argparser.add_argument(
+        '-o', '--output', default=None, metavar='FILE',
+        help='-a export to FILE instead of stdout, gzipped if it ends in .gz')
+    argparser.add_argument(
+        '--gzip', action='store_true',
+        help='-a export gzipped output')
+    # HTTP transport
+    argparser.add_argument(
+        '--pool-size', default=POOL_SIZE, type=int, metavar='N',
+        help='keep-alive connections to NetBox (default: %(default)s)')
+    argparser.add_argument(
+        '--http-timeout', default=HTTP_TIMEOUT, type=float,
+        metavar='SECONDS',
+        help='wait this long for a response (default: %(default)s)')
+    argparser.add_argument(
+        '--retries', default=RETRIES, type=int, metavar='N',
+        help='retry transient failures N times (default: %(default)s)')
+    # local snapshot cache
+    argparser.add_argument(
+        '--refresh', action='store_true',
+        help='bring the local snapshot cache up to date before using it')
+    argparser.add_argument(
+        '--no-cache', action='store_true',
+        help='ignore the local snapshot cache and download everything')
+    argparser.add_argument(
+        '--cache-ttl', default=CACHE_TTL, type=int, metavar='SECONDS',
+        help='age after which a snapshot is refreshed (default: %(default)s)')
 
     # exit with --help if no arguments
     if len(sys.argv[1:]) == 0:
@@ -87,62 +1415,837 @@ def ArgParse(argparser):
     args = argparser.parse_args()
     if (args.action == 'list') and args.type is None:
         argparser.error("-a list requires -t [type]")
-    return vars(args)
+    if args.instance and args.manifest:
+        argparser.error("--manifest runs against one NetBox, "
+                        "not --instance")
+    return Arguments(vars(args))
 
 
 # =============================
-# Functions for pretty printing outputs
-def print_row(column1, column2):
-    print "%-35s %-15s" % (column1, column2)
+# Table output
+#
+# Every listing prints through a Table: the column headings of each kind of
+# row are in TABLES, the widths are sized to fit the first TABLE_SAMPLE rows
+# (a longer value later pushes its row out, nothing is cut), and rows are
+# formatted and written TABLE_CHUNK at a time instead of a print each.
+# --tsv writes tab separated values instead, --pager pipes it all through
+# $PAGER.
+TABLE_SAMPLE = 200      # rows looked at to size the columns
+TABLE_CHUNK = 1000      # rows formatted and written at a time
+TABLE_MAX_WIDTH = 50    # widest a column is padded to
+TABLES = {
+    'line': ('',),
+    'asset': ('NAME', 'ASSET TAG'),
+    'serial': ('SERIAL', 'NAME'),
+    'serial_locate': ('SERIAL', 'NAME', 'MODEL', 'SITE'),
+    'device': ('NAME', 'PRIMARY IP', 'MODEL', 'STATUS', 'SERIAL',
+               'ASSET TAG'),
+    'device_locate': ('NAME', 'MODEL', 'SITE', 'RACK', 'RACK LOCATION',
+                      'ASSET TAG', 'SN'),
+    'ip': ('IP_ADDRESS', 'INTERFACE', 'DEVICE', 'STATUS', 'VLAN',
+           'DESCRIPTION'),
+    'ip_device': ('Device', 'IP', 'Interface'),
+    'ip_prefix': ('IP', 'PREFIX'),
+    'vlan': ('VLAN', 'SITE', 'PREFIX', 'STATUS', 'DESCRIPTION'),
+    'circuit': ('ID', 'TYPE', 'PROVIDER', 'A-SIDE', 'Z-SIDE', 'DESCRIPTION'),
+    'rack': ('NAME', 'SITE', 'ROLE'),
+    'prefix': ('PREFIX', 'STATUS', 'SITE', 'VLAN', 'ROLE', 'DESCRIPTION'),
+    'interface': ('DEVICE', 'INTERFACE', 'TYPE', 'ENABLED', 'MAC ADDRESS',
+                  'DESCRIPTION'),
+    'where': ('LINE', 'INSTANCES'),
+}
+
+
+def cell(value):
+    """Return value as the text of a table cell."""
+    if isinstance(value, basestring):
+        return value
+    return '%s' % value
+
+
+class Table(object):
+    """Write rows of one of the TABLES, aligned or as --tsv.
+
+    headers defaults to --headers; footer ends the table with a rule.
+    Rows are held until close(), or until enough of them have come, and
+    then formatted a whole row per % with the widths of the sample.  Run
+    against several --instance, every row starts with the instance name.
+    """
 
+    def __init__(self, kind, headers=None, footer=False):
+        self.headings = TABLES[kind]
+        self.tag = instance().name if fanout else None
+        if self.tag:
+            self.headings = ('INSTANCE',) + self.headings
+        if headers is None:
+            headers = arguments.get('headers')
+        self.headers = bool(headers) and any(self.headings)
+        self.footer = footer
+        self.tsv = bool(arguments.get('tsv'))
+        self.pending = []   # rows as tuples, notes and headers as strings
+        self.format = None
+        self.width = 0
+
+    def row(self, *values):
+        if self.tag:
+            values = (self.tag,) + values
+        self.pending.append(values)
+        if self.format is None:
+            if len(self.pending) >= TABLE_SAMPLE:
+                self.size()
+        elif len(self.pending) >= TABLE_CHUNK:
+            self.flush()
+
+    def note(self, line):
+        """Print a line as it is, in order with the rows."""
+        self.pending.append(cell(line))
+
+    def size(self):
+        """Fix the column widths to fit the rows so far, add the header."""
+        count = len(self.headings)
+        if self.tsv:
+            self.format = '\t'.join(['%s'] * count)
+        else:
+            widths = [len(heading) if self.headers else 0
+                      for heading in self.headings]
+            for row in self.pending:
+                if isinstance(row, tuple):
+                    widths = [max(width, len(cell(value)))
+                              for width, value in zip(widths, row)]
+            widths = [min(width, TABLE_MAX_WIDTH) for width in widths]
+            # the last column is not padded
+            self.format = ''.join('%%-%ds  ' % width
+                                  for width in widths[:-1]) + '%s'
+            self.width = sum(widths) + 2 * (count - 1)
+        if self.headers:
+            header = [self.format % self.headings]
+            if not self.tsv:
+                header.append('-' * self.width)
+            self.pending[:0] = header
+
+    def lines(self):
+        format = self.format
+        for row in self.pending:
+            if not isinstance(row, tuple):
+                line = row
+            elif self.tsv:
+                line = format % tuple(
+                    cell(value).replace('\t', ' ').replace('\n', ' ')
+                    for value in row)
+            else:
+                line = format % row
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            yield line
+
+    def flush(self):
+        with stats.timing(OUTPUT_TIMER):
+            if self.format is None:
+                self.size()
+            if self.pending:
+                sys.stdout.write('\n'.join(self.lines()) + '\n')
+            del self.pending[:]
+
+    def close(self):
+        self.flush()
+        if self.footer and not self.tsv and self.width:
+            sys.stdout.write('-' * self.width + '\n')
+
+
+def start_pager():
+    """Send everything printed through $PAGER, when stdout is a terminal."""
+    import subprocess
+    if not sys.stdout.isatty():
+        return
+    pager = subprocess.Popen(os.environ.get('PAGER') or 'less -FRSX',
+                             shell=True, stdin=subprocess.PIPE)
+    sys.stdout = pager.stdin
+
+    def wait():
+        try:
+            pager.stdin.close()
+        except IOError:
+            pass
+        pager.wait()
+    atexit.register(wait)
 
-def print_row(column1, column2):
-    print "%-35s %-15s" % (column1, column2)
 
+# =============================
+# IP address index
+#
+# Addresses and prefixes are held as integers in sorted arrays, IPv4 and
+# IPv6 apart, and looked up by binary search.  Addresses match on the host
+# whatever the mask, like NetBox's address= filter, so 10.0.0.1, 10.0.0.1/24
+# and 10.0.0.1/32 are one address, as are all spellings of an IPv6 address.
+# Prefixes are kept per length; finding the most specific prefix containing
+# an address takes one search per prefix length in use.
+def parse_ip(text):
+    """Return (bits, number, length) for '10.0.0.1/24' or '2001:db8::/32'.
+
+    bits is 32 or 128 and length defaults to bits.  Raises ValueError for
+    anything that is not an IP address or prefix.
+    """
+    address, _, length = text.strip().partition('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    try:
+        packed = socket.inet_pton(family, address)
+    except (socket.error, UnicodeError):
+        raise ValueError('not an IP address: %r' % text)
+    bits = len(packed) * 8
+    length = int(length) if length else bits
+    if not 0 <= length <= bits:
+        raise ValueError('bad prefix length: %r' % text)
+    return bits, int(binascii.hexlify(packed), 16), length
+
+
+def valid_ips(lines):
+    """Return the lines that parse as IP addresses."""
+    valid = []
+    for line in lines:
+        try:
+            parse_ip(line)
+        except ValueError:
+            continue
+        valid.append(line)
+    return valid
 
-def print_row1(column1):
-    print "%-35s" % (column1)
 
+class IPIndex(object):
+    """Exact-match and containment lookups over addresses and prefixes."""
 
-def print_row2(column1, column2):
-    print "%-30s %-15s" % (column1, column2)
+    def __init__(self, addresses=(), prefixes=()):
+        self.hosts = {}         # bits: (numbers, objects)
+        self.networks = {}      # bits: [(length, numbers, objects)]
+        hosts = {}
+        for obj in addresses:
+            try:
+                bits, number, length = parse_ip(obj.address or '')
+            except ValueError:
+                continue
+            hosts.setdefault(bits, []).append((number, obj))
+        for bits, entries in hosts.items():
+            self.hosts[bits] = self.column(bits, entries)
+        networks = {}
+        for obj in prefixes:
+            try:
+                bits, number, length = parse_ip(obj.prefix or '')
+            except ValueError:
+                continue
+            number = number >> (bits - length) << (bits - length)
+            networks.setdefault((bits, length), []).append((number, obj))
+        # longest prefixes first, the first hit is the most specific
+        for (bits, length), entries in sorted(networks.items(), reverse=True):
+            self.networks.setdefault(bits, []).append(
+                (length,) + self.column(bits, entries))
+
+    @staticmethod
+    def column(bits, entries):
+        """Return (sorted numbers, objects in the same order)."""
+        entries.sort(key=lambda entry: entry[0])
+        numbers = [number for number, obj in entries]
+        if bits == 32:
+            numbers = array.array('L', numbers)     # no array holds 128 bits
+        return numbers, [obj for number, obj in entries]
+
+    def get(self, text, default=None):
+        """Return the addresses with the host of text, like dict.get()."""
+        try:
+            bits, number, length = parse_ip(text)
+        except ValueError:
+            return default
+        numbers, objects = self.hosts.get(bits, ((), ()))
+        start = bisect.bisect_left(numbers, number)
+        end = bisect.bisect_right(numbers, number, start)
+        return objects[start:end] or default
+
+    def containing(self, text):
+        """Return the most specific prefix containing text, or None."""
+        try:
+            bits, number, length = parse_ip(text)
+        except ValueError:
+            return None
+        for size, numbers, objects in self.networks.get(bits, ()):
+            if size > length:
+                continue
+            network = number >> (bits - size) << (bits - size)
+            i = bisect.bisect_left(numbers, network)
+            if i < len(numbers) and numbers[i] == network:
+                return objects[i]
+        return None
 
 
-def print_row3(column1, column2, column3):
-    print "%-30s %-15s %-15s" % (column1, column2, column3)
+# =============================
+# Name normalization and "did you mean"
+#
+# --normalize folds the lines of a file and the NetBox keys alike before
+# they are matched: case folds case, fqdn drops the domain of device names,
+# sep drops - _ . and blanks, so core-01, core_01 and core01 are one name.
+# --suggest ranks the NetBox keys by the trigrams they share with a line
+# that was not found, through an inverted index.  Only the posting lists of
+# the rarest trigrams of the line are walked, up to SUGGEST_BUDGET entries,
+# as those are the ones that tell names apart; the keys found in most of
+# them are scored exactly.  A miss costs a few short lists instead of a
+# pass over the table.
+NORMALIZE_RULES = ('case', 'fqdn', 'sep')
+SEPARATORS = re.compile(r'[-_. ]+')
+SUGGEST_SCORE = 0.5     # least Dice similarity of trigram sets to suggest
+SUGGEST_BUDGET = 5000   # posting list entries walked per line
+SUGGEST_VERIFY = 20     # candidates scored exactly per line
+
+
+def normalize_rules(text):
+    """Return the rules in 'case,fqdn,sep' ('all' for all) as a tuple."""
+    if isinstance(text, (list, tuple)):
+        text = ','.join(text)
+    rules = [rule.strip() for rule in (text or '').split(',')
+             if rule.strip()]
+    if rules == ['all']:
+        return NORMALIZE_RULES
+    for rule in rules:
+        if rule not in NORMALIZE_RULES:
+            raise ValueError('unknown --normalize rule %r, use %s or all'
+                             % (rule, ','.join(NORMALIZE_RULES)))
+    return tuple(sorted(set(rules)))
+
+
+def normalizer(kind, rules):
+    """Return the function rules apply to lines and keys of -t kind.
+
+    None when there is nothing to do; IP addresses are never normalized.
+    """
+    if not rules or kind == 'ip':
+        return None
+
+    def fold(text):
+        if 'sep' in rules:
+            text = SEPARATORS.sub('', text)
+        if 'case' in rules:
+            text = text.lower()
+        return text
+
+    def host(text):
+        if 'fqdn' in rules:
+            text = text.partition('.')[0]
+        return fold(text)
+
+    def interface(text):
+        device, _, name = text.partition(':')
+        return '%s:%s' % (host(device), fold(name))
+
+    return {'device': host, 'interface': interface}.get(kind, fold)
+
+
+def trigrams(text):
+    """Return the set of trigrams of text, case folded and padded."""
+    text = '  %s ' % text.lower()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TrigramIndex(object):
+    """Look up the keys most similar to a text by their shared trigrams."""
+
+    def __init__(self, keys):
+        self.keys = sorted(set(key for key in keys if key))
+        self.postings = {}
+        for number, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                self.postings.setdefault(gram, []).append(number)
+
+    def similar(self, text, limit=3):
+        """Return up to limit keys similar to text, most similar first."""
+        grams = trigrams(text)
+        lists = sorted((self.postings.get(gram, ()) for gram in grams),
+                       key=len)
+        counts = {}
+        budget = SUGGEST_BUDGET
+        for posting in lists:
+            if budget < len(posting) and counts:
+                break
+            budget -= len(posting)
+            for number in posting:
+                counts[number] = counts.get(number, 0) + 1
+        scored = []
+        for number in heapq.nlargest(SUGGEST_VERIFY, counts, key=counts.get):
+            key = self.keys[number]
+            other = trigrams(key)
+            score = 2.0 * len(grams & other) / (len(grams) + len(other))
+            if score >= SUGGEST_SCORE:
+                scored.append((-score, key))
+        return [key for score, key in sorted(scored)[:limit]]
+
+
+def suggestions(kind, objects, rules=()):
+    """Return suggest(line, limit) over the NetBox keys of objects.
+
+    Lines and keys are compared normalized by rules, the keys are returned
+    as NetBox spells them.
+    """
+    keys = RECONCILE[kind][2]
+    normalize = normalizer(kind, rules) or (lambda text: text)
+    names = {}
+    for obj in objects:
+        for key in keys(obj):
+            if key:
+                names.setdefault(normalize(key), key)
+    index = TrigramIndex(names)
+
+    def suggest(line, limit):
+        return [names[key] for key in index.similar(normalize(line), limit)]
+    return suggest
+
+
+def did_you_mean(kind, objects):
+    """Return a function giving the --suggest keys for a line not found.
+
+    None without --suggest.  objects() returns the NetBox objects to
+    suggest from, it is called for the first line; --manifest and serve
+    share one index of the whole table instead.
+    """
+    limit = arguments.get('suggest')
+    if not limit or kind == 'ip':
+        return None
+    rules = tuple(arguments.get('normalize') or ())
+    made = {}
+
+    def suggest(line):
+        if 'index' not in made:
+            if shared() and kind != 'interface':
+                path, field, keys, columns = RECONCILE[kind]
+                made['index'] = once(('suggest', kind, rules), lambda: (
+                    suggestions(kind, fetch_all(path, columns), rules)))
+            else:
+                made['index'] = suggestions(kind, objects(), rules)
+        return made['index'](line, limit)
+    return suggest
+
+
+# =============================
+# Reconciliation of input files against NetBox
+#
+# Both sides are matched through an index, so a check is linear in the size
+# of the file plus the size of the table.  Every object type says which
+# filter field to look up and which keys an object answers to; IP addresses
+# are matched as numbers through an IPIndex instead.
+def name_keys(obj):
+    return [(obj.name or '').strip()]
 
 
-def print_row4(column1, column2, column3, column4):
-    print "%-15s %-30s %-15s %-15s" % (column1, column2, column3, column4)
+def serial_keys(obj):
+    return [(obj.serial or '').strip()]
 
 
-def print_row6(column1, column2, column3, column4, column5, column6):
-    print("%-35s%-20s%-30s%-15s%-15s%-15s" %
-          (column1, column2, column3, column4, column5, column6))
+def asset_tag_keys(obj):
+    return [(obj.asset_tag or '').strip()]
 
 
-def print_row7(column1, column2, column3, column4, column5, column6, column7):
-    print("%-35s%-20s%-30s%-15s%-15s%-15s%-15s" %
-          (column1, column2, column3, column4, column5, column6, column7))
+def address_keys(obj):
+    return [(obj.address or '').strip()]
 
 
-def print_row_ip(column1, column2, column3, column4, column5, column6):
-    print("%-20s%-25s%-30s%-15s%-15s%-15s" %
-          (column1, column2, column3, column4, column5, column6))
+def interface_keys(obj):
+    return ['%s:%s' % (obj.device_name, obj.name)]
 
 
-def print_row_vlan(column1, column2, column3, column4, column5):
-    print("%-40s%-10s%-30s%-15s%-15s" %
-          (column1, column2, column3, column4, column5))
+# kind: (path, filter field, key function, columns the reports print)
+RECONCILE = {
+    'device': ('dcim/devices', 'name', name_keys, ('name',)),
+    'asset': ('dcim/devices', 'asset_tag', asset_tag_keys,
+              ('name', 'display_name', 'asset_tag')),
+    'asset_tag': ('dcim/devices', 'asset_tag', asset_tag_keys,
+                  ('name', 'display_name', 'asset_tag')),
+    'serial': ('dcim/devices', 'serial', serial_keys, ('name', 'serial')),
+    'ip': ('ipam/ip-addresses', 'address', address_keys,
+           ('address', 'interface', 'interface.device.name')),
+    'interface': ('dcim/interfaces', 'device', interface_keys,
+                  ('device.name', 'name')),
+}
 
 
-def print_row_rack(column1, column2, column3):
-    print "%-20s %-15s %-15s" % (column1, column2, column3)
+def read_lines(filename):
+    """Return the stripped, non-empty lines of an input file."""
+    with open(filename) as file:
+        return [line.strip() for line in file if line.strip()]
 
 
-def print_row_prefix(column1, column2, column3, column4, column5, column6):
-    print("%-30s%-15s%-15s%-30s%-20s%-15s" %
-          (column1, column2, column3, column4, column5, column6))
+def line_index(kind, objects, rules=()):
+    """Return the index that lines of -t kind are looked up in.
+
+    For most kinds that is {key: [objects]} of the keys normalized by
+    rules (see normalizer()), for IPs an IPIndex.
+    """
+    if kind == 'ip':
+        return IPIndex(addresses=objects)
+    keys = RECONCILE[kind][2]
+    normalize = normalizer(kind, rules)
+    index = {}
+    for obj in objects:
+        for key in keys(obj):
+            if key and normalize:
+                key = normalize(key)
+            if key:
+                index.setdefault(key, []).append(obj)
+    return index
+
+
+def lookup_keys(kind, lines):
+    """Return the lines worth sending to NetBox as filters for -t kind."""
+    if kind == 'ip':
+        # NetBox matches address= on the mask too when one is given, so ask
+        # for the hosts and let the IPIndex match the masks; an invalid
+        # address makes it reject the whole query
+        return sorted(set(line.partition('/')[0].strip()
+                          for line in valid_ips(lines)))
+    if kind == 'interface':
+        return sorted(set(line.partition(':')[0] for line in lines))
+    return lines
+
+
+def reconcile(lines, objects, index, normalize=None):
+    """Split lines and objects into in both, only in file, only in NetBox.
+
+    index is the line_index() of objects, and normalize the normalizer()
+    it was built with.  Returns (both, fileonly, nbonly)
+    where both is a list of (line, objects) in file order, fileonly the
+    unmatched lines and nbonly the objects no line matched, in NetBox
+    order.  Duplicate lines are reported once.
+    """
+    both = []
+    fileonly = []
+    seen = set()
+    matched = set()
+    for line in lines:
+        if line in seen:
+            continue
+        seen.add(line)
+        found = index.get(normalize(line) if normalize else line)
+        if found:
+            both.append((line, found))
+            matched.update(id(obj) for obj in found)
+        else:
+            fileonly.append(line)
+    nbonly = [obj for obj in objects if id(obj) not in matched]
+    return both, fileonly, nbonly
+
+
+def check_file(kind, lines):
+    """Fetch what is needed from NetBox and reconcile lines for -t kind.
+
+    With --match, in every instance at once, see check_instances().
+    """
+    if matching:
+        return check_instances(kind, lines)[:3]
+    return check_netbox(kind, lines)
+
+
+def check_netbox(kind, lines):
+    """check_file() in the current Instance."""
+    path, field, keys, columns = RECONCILE[kind]
+    rules = tuple(arguments.get('normalize') or ())
+    normalize = normalizer(kind, rules)
+    if kind == 'interface':
+        # never the whole table, only the devices in the file
+        devices = lookup_keys(kind, lines)
+        if normalize:
+            # the file spells the device names its own way, find NetBox's
+            host = normalizer('device', rules)
+            wanted = set(host(device) for device in devices)
+            devices = [obj.name for obj in fetch_all('dcim/devices',
+                                                     ('name',))
+                       if obj.name and host(obj.name) in wanted]
+        objects = fetch_interfaces(devices, columns)
+    else:
+        wanted = lookup_keys(kind, lines)
+        params = listing_params(path, columns)
+        # the NetBox-only side of a diff, normalized keys and suggestions
+        # need the whole table
+        if not arguments.get('diff') and not normalize and \
+                not arguments.get('suggest') and \
+                plan_lookup(path, len(wanted), params) == 'point':
+            objects = fetch_matching(path, field, wanted, columns)
+        elif shared():
+            # checks of a manifest or serve share the table and its index
+            objects, index = once(('index', kind, rules),
+                                  lambda: table_index(kind, rules))
+            return reconcile(lines, objects, index, normalize)
+        else:
+            objects = fetch_all(path, columns)
+    return reconcile(lines, objects, line_index(kind, objects, rules),
+                     normalize)
+
+
+def check_instances(kind, lines):
+    """check_netbox() lines in each of the --match instances at once.
+
+    Returns (both, fileonly, nbonly, where): like reconcile(), a line is in
+    both when any instance has it, nbonly has the objects of every instance
+    that no line matched, and where is (line, [instance names]) for every
+    line, in file order.  An object more than one instance has no line for
+    is in nbonly once.
+    """
+    keys = RECONCILE[kind][2]
+
+    def check(site):
+        with using(site):
+            return check_netbox(kind, lines)
+    pool = thread_pool(len(matching))
+    try:
+        results = pool.map(check, matching)
+    finally:
+        pool.terminate()
+    found = {}
+    names = {}
+    nbonly = []
+    listed = set()
+    for site, (both, fileonly, extra) in zip(matching, results):
+        for line, objs in both:
+            found.setdefault(line, []).extend(objs)
+            names.setdefault(line, []).append(site.name)
+        for obj in extra:
+            key = (keys(obj) or [None])[0]
+            if key is None or key not in listed:
+                listed.add(key)
+                nbonly.append(obj)
+    both = []
+    fileonly = []
+    where = []
+    seen = set()
+    for line in lines:
+        if line in seen:
+            continue
+        seen.add(line)
+        if line in found:
+            both.append((line, found[line]))
+        else:
+            fileonly.append(line)
+        where.append((line, names.get(line, [])))
+    return both, fileonly, nbonly, where
+
+
+def table_index(kind, rules=()):
+    """Return the whole table for -t kind and its line_index()."""
+    path, field, keys, columns = RECONCILE[kind]
+    objects = fetch_all(path, columns)
+    return objects, line_index(kind, objects, rules)
+
+
+def print_diff(kind, both, fileonly, nbonly, suggest=None):
+    """Print a three-way diff: '=' in both, '-' only in file, '+' only NetBox.
+
+    With suggest (see did_you_mean()) a '?' line after a '-' line lists the
+    NetBox keys it may have meant.
+    """
+    keys = RECONCILE[kind][2]
+    print('# %d in both, %d only in file, %d only in NetBox' %
+          (len(both), len(fileonly), len(nbonly)))
+    for line, objs in both:
+        print('= %s' % line)
+    for line in fileonly:
+        print('- %s' % line)
+        print_hint('? %s', line, suggest)
+    for obj in nbonly:
+        print('+ %s' % (keys(obj)[0] or getattr(obj, 'name', '')))
+
+
+def print_hint(template, line, suggest, table=None):
+    """Print the --suggest keys for a line not found, if there are any.
+
+    With a table they go in it, after the rows already given to it.
+    """
+    hints = suggest(line) if suggest else None
+    if hints and table:
+        table.note(template % ', '.join(hints))
+    elif hints:
+        print(template % ', '.join(hints))
+
+
+def matched_objects(found, extra):
+    """Return every object check_file() returned, for did_you_mean()."""
+    return itertools.chain((obj for line, objs in found for obj in objs),
+                           extra)
+
+
+def report_file(kind, both=None, fileonly=None, nbonly=None, table=None):
+    """Check the -f file of -t kind against NetBox and report the results.
+
+    both(line, objects), fileonly(line) and nbonly(obj) are called, when
+    given, for the results of reconcile(): all of both, then fileonly, then
+    nbonly.  With --external they come interleaved in key order, as the
+    merge finds them.  --suggest adds a line after each fileonly(), in the
+    Table they print to if there is one.
+    """
+    path, field, keys, columns = RECONCILE[kind]
+    if external(kind):
+        results = external_check(kind, arguments['file'])
+        suggest = did_you_mean(kind, lambda: iter_all(path, columns))
+    else:
+        found, missing, extra = check_file(kind,
+                                           read_lines(arguments['file']))
+        results = itertools.chain(
+            (('=', line, objs) for line, objs in found),
+            (('-', line, None) for line in missing),
+            (('+', None, obj) for obj in extra))
+        suggest = did_you_mean(kind, lambda: matched_objects(found, extra))
+    for tag, line, objs in results:
+        if tag == '=' and both:
+            both(line, objs)
+        elif tag == '-' and fileonly:
+            fileonly(line)
+            print_hint('    did you mean: %s', line, suggest, table)
+        elif tag == '+' and nbonly:
+            nbonly(objs)
+
+
+def diff_file(kind):
+    """Print the three-way diff of the -f file of -t kind, see print_diff().
+
+    With --external the counts come last, once the merge is done.
+    """
+    path, field, keys, columns = RECONCILE[kind]
+    if not external(kind):
+        found, missing, extra = check_file(kind,
+                                           read_lines(arguments['file']))
+        print_diff(kind, found, missing, extra, did_you_mean(
+            kind, lambda: matched_objects(found, extra)))
+        return
+    suggest = did_you_mean(kind, lambda: iter_all(path, columns))
+    counts = collections.Counter()
+    for tag, line, obj in external_check(kind, arguments['file']):
+        counts[tag] += 1
+        if tag == '+':
+            line = keys(obj)[0] or getattr(obj, 'name', '')
+        print('%s %s' % (tag, line))
+        if tag == '-':
+            print_hint('? %s', line, suggest)
+    print('# %d in both, %d only in file, %d only in NetBox' %
+          (counts['='], counts['-'], counts['+']))
+
+
+# =============================
+# --external: reconciliation in bounded memory
+#
+# For input files too big to hold.  Both sides become 'key\0record' lines,
+# sorted --run-size lines at a time and spilled to temporary files, and the
+# runs of each side are merged with heapq.merge().  Walking the two sorted
+# streams side by side gives the answers of reconcile(), in key order and as
+# soon as each key is done.  Memory holds one run while sorting and a line
+# per run while merging; the whole NetBox table is always read, streamed
+# from the cache or the API.
+def external(kind):
+    """Return whether -t kind is reconciled with --external."""
+    return bool(arguments.get('external')) and kind != 'interface' and \
+        not matching
+
+
+def match_key(kind, text):
+    """Return the key a line or NetBox key of -t kind sorts and matches by.
+
+    IPs match on the host whatever the mask, like IPIndex; None for an
+    unparseable one.
+    """
+    if kind != 'ip':
+        return text
+    try:
+        bits, number, length = parse_ip(text)
+    except ValueError:
+        return None
+    return '%03d:%032x' % (bits, number)
+
+
+def sorted_runs(records, size):
+    """Return an iterator over the distinct records (strings), sorted.
+
+    They are sorted size at a time and each sorted run spilled to a
+    temporary file, which are merged as the iterator is consumed.  Equal
+    records in a run are written once, equal records of different runs
+    still come out next to each other.
+    """
+    records = iter(records)
+    runs = []
+    while True:
+        run = sorted(set(itertools.islice(records, size)))
+        if not run:
+            break
+        spill = tempfile.TemporaryFile()
+        spill.writelines(record + '\n' for record in run)
+        spill.seek(0)
+        runs.append(spill)
+        del run
+    logger.debug(lineno() + ': ' + str(len(runs)) + ' sorted runs')
+    return heapq.merge(*[(line[:-1] for line in spill) for spill in runs])
+
+
+def external_check(kind, filename):
+    """Reconcile a file with NetBox for -t kind in bounded memory.
+
+    Yields ('=', line, objects), ('-', line, None) and ('+', None, obj) in
+    key order; like reconcile(), duplicate lines are reported once.
+    """
+    path, field, keys, columns = RECONCILE[kind]
+    size = arguments.get('run_size') or RUN_SIZE
+    make = row_type(columns)._make
+    normalize = normalizer(kind, tuple(arguments.get('normalize') or ()))
+    if normalize is None:
+        def normalize(text):
+            return text
+
+    def file_records():
+        with open(filename) as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                key = match_key(kind, normalize(line))
+                if key == line:
+                    yield line      # the line is its own key
+                else:
+                    if key is None:
+                        key = '~' + line    # after every IP, matches none
+                    yield '%s\0%s' % (key, line)
+
+    def netbox_records():
+        for obj in iter_all(path, columns):
+            payload = json.dumps(list(obj))
+            for key in keys(obj):
+                key = match_key(kind, normalize(key)) if key else None
+                if isinstance(key, unicode):
+                    key = key.encode('utf-8')
+                yield '%s\0%s' % (key or '', payload)
+
+    def split(record):
+        return record.partition('\0')[0]
+
+    def lines(group):
+        last = None
+        for record in group:
+            key, sep, line = record.partition('\0')
+            line = line if sep else key
+            if line != last:    # duplicates sort next to each other
+                yield line
+                last = line
+
+    def objects(group):
+        for record in group:
+            yield make(json.loads(record.partition('\0')[2]))
+
+    files = itertools.groupby(sorted_runs(file_records(), size), split)
+    netbox = itertools.groupby(sorted_runs(netbox_records(), size), split)
+    fkey, fgroup = next(files, (None, None))
+    nkey, ngroup = next(netbox, (None, None))
+    while fgroup is not None or ngroup is not None:
+        if ngroup is None or fgroup is not None and fkey < nkey:
+            for line in lines(fgroup):
+                yield '-', line, None
+            fkey, fgroup = next(files, (None, None))
+        elif fgroup is None or nkey < fkey:
+            for obj in objects(ngroup):
+                yield '+', None, obj
+            nkey, ngroup = next(netbox, (None, None))
+        else:
+            found = list(objects(ngroup))
+            for line in lines(fgroup):
+                yield '=', line, found
+            fkey, fgroup = next(files, (None, None))
+            nkey, ngroup = next(netbox, (None, None))
 
 
 # =============================
@@ -150,49 +2253,42 @@ def print_row_prefix(column1, column2, column3, column4, column5, column6):
 # Should split into further cleaner functions
 
 def dcim(txtfile, type, reversecheck):
-    response = nb.dcim.devices.all()
-    csvname = arguments['file']
     # need to make the file optional - sometimes we just want to
     # query and see matching devices
     try:
-        with open(csvname) as file:
-            lines = [line.strip() for line in file]
+        if arguments['diff']:
+            diff_file(type)
 
-        if arguments['type'] == 'device':
-            string_list = [str(item) for item in response]
-            strip_list = [item.strip() for item in string_list]
-            a = set(lines)
-            b = set(strip_list)
-            common = a.intersection(b)
-            notInSet2 = a.difference(b)
+        elif type == 'device':
             if reversecheck:
                 print "\nThese devices were not found in NetBox:"
                 print '---------------------------------------'
-                for line in notInSet2:
-                    print_row1(line)
+                table = Table('line')
+                report_file(type, fileonly=table.row, table=table)
+                table.close()
                 print '\n'
             else:
                 print "\nThese devices were found in NetBox:"
                 print '-----------------------------------'
-                for line in common:
-                    print_row1(line)
+                table = Table('line')
+                report_file(type,
+                            both=lambda line, devices: table.row(line))
+                table.close()
                 print '\n'
 
-        elif ((arguments['type'] == 'asset_tag') or
-              (arguments['type'] == 'asset')):
+        elif (type == 'asset_tag') or (type == 'asset'):
             if reversecheck:
-                for line in response:
-                    for lul in lines:
-                        if (str(line.asset_tag) == str(lul)):
-                            print_row2(str(line.display_name),
-                                       str(line.asset_tag))
+                table = Table('asset')
+
+                def show(line, devices):
+                    for device in devices:
+                        table.row(device.display_name, device.asset_tag)
+                report_file(type, both=show)
+                table.close()
             else:
-                for line in response:
-                    for lul in lines:
-                        if (str(line.asset_tag) == str(lul)):
-                            lines.remove(lul)
-                for notinnb in lines:
+                def show(notinnb):
                     print(notinnb)
+                report_file(type, fileonly=show)
 
     except IOError:
         print '\nThe file does not exist'
@@ -205,47 +2301,31 @@ def dcim(txtfile, type, reversecheck):
 #
 def ipam(txtfile, query, reversecheck):
     try:
-        hasSlash = False
-        with open(arguments['file']) as file:
-            checkList = [line.strip() for line in file]
-        # Check for / in the infile
-        if checkList[1].find('/') > -1:
-            hasSlash = True
-        inNetbox = nb.ipam.ip_addresses.all()
-        if reversecheck:
-            print_row3("Device", "IP", "Interface")
-            for nbip in inNetbox:
-                cleannbip = str(nbip.address)
-                if not hasSlash:
-                    cleannbip = cleannbip[:-3]
-                for inip in checkList:
-                    if cleannbip == str(inip):
-                        try:
-                            print_row3(str(nbip.interface.device.name),
-                                       cleannbip, str(nbip.interface))
-                            checkList.remove(inip)
-                        except AttributeError:
-                                try:
-                                    print_row3(str(nbip.assignment), str(inip),
-                                               str(nbip.interface))
-                                    checkList.remove(inip)
-                                except AttributeError:
-                                        print_row3(str("no device"), str(inip),
-                                                   str(nbip.interface))
-                                        checkList.remove(inip)
-                    else:
-                        pass
+        if arguments['diff']:
+            diff_file('ip')
+        elif reversecheck:
+            table = Table('ip_device', headers=True)
+
+            def show(inip, nbips):
+                for nbip in nbips:
+                    device = nbip.interface_device_name or "no device"
+                    table.row(device, inip, nbip.interface)
+            report_file('ip', both=show)
+            table.close()
         else:
-            for nbip in inNetbox:
-                cleannbip = str(nbip.address)
-                if not hasSlash:
-                    cleannbip = cleannbip[:-3]
-                for inip in checkList:
-                    if cleannbip == str(inip):
-                        checkList.remove(inip)
+            # show the NetBox prefix each unregistered address falls in,
+            # fetched with the first one
+            prefixes = {}
+            table = Table('ip_prefix')
+
+            def show(item):
+                if 'index' not in prefixes:
+                    prefixes['index'] = prefix_index()
+                covering = prefixes['index'].containing(item)
+                table.row(item, covering.prefix if covering else '-')
             print("\nNot in NetBox")
-            for item in checkList:
-                print(item)
+            report_file('ip', fileonly=show, table=table)
+            table.close()
     except IOError:
         print('\nFile does not exist')
     except KeyboardInterrupt:
@@ -253,72 +2333,85 @@ def ipam(txtfile, query, reversecheck):
         sys.exit()
 
 
-def querysearch(query):
-    try:
-        response = nb.dcim.devices.filter(query)
-        print('\nDEVICE')
-        for device in response:
-            print_row7(device.display_name, device.device_type,
-                       device.site.name, device.rack, device.position,
-                       device.asset_tag, device.serial)
+def prefix_index():
+    """Return an IPIndex of every prefix in NetBox.
 
-    except AttributeError:
-        pass
-    try:
-        response = nb.ipam.prefixes.filter(query)
-        print('\nPREFIXES')
-        for obj in response:
-            print_row_prefix(obj.prefix, obj.status.label, obj.site,
-                             obj.vlan, obj.role, obj.description)
-    except AttributeError:
-        pass
-    try:
-        response = nb.ipam.ip_addresses.filter(query)
-        print('\nIP_ADDRESSES')
-        for ip in response:
-            print_row_ip(ip.address, ip.interface, ip.vrf,
-                         ip.status, '-', ip.description)
-    except AttributeError:
-        pass
-    try:
-        response = nb.ipam.vlans.filter(query)
-        print('\nVLANS')
-        for vlan in response:
-            print_row_vlan(vlan.display_name, vlan.site.name,
-                           vlan.group, vlan.status, vlan.description)
-    except AttributeError:
-        pass
-    try:
-        response = nb.tenancy.tenants.filter(query)
-        print('\nTENANTS')
-        for line in response:
-            print(line)
-    except AttributeError:
-        pass
+    --manifest and serve build it once and share it.
+    """
+    def make():
+        return IPIndex(prefixes=fetch_all('ipam/prefixes', ('prefix',)))
+    if shared():
+        return once(('prefixes',), make)
+    return make()
 
 
 def change_name(txtfile):
     """Bulk rename devices currently in netbox.
     Requires a TSV with one OLD_NAME\tNEW_NAME on each line.
+
+    All old names are looked up in chunked queries, then the renames are sent
+    as batched bulk PATCH requests.  --dry-run only shows the plan.
     """
-    # TODO: need error check for when dummy passes in file without new names
     try:
         csvname = arguments['file']
         names = []
+        badrows = []
         notfound = []
         with open(csvname, 'rb') as f:
             reader = csv.reader(f, delimiter='\t')
-            for row in reader:
-                names.append(row)
+            for lineNo, row in enumerate(reader, 1):
+                row = [column.strip() for column in row]
+                if len(row) >= 2 and row[0] and row[1]:
+                    names.append(row)
+                elif any(row):
+                    badrows.append((lineNo, '\t'.join(row)))
+        if len(badrows) > 0:
+            print('\nThese lines are not OLD_NAME<tab>NEW_NAME and were '
+                  'skipped:')
+            for lineNo, line in badrows:
+                print('%5d: %s' % (lineNo, line))
+
+        start = time.time()
+        # names are only unique per site, one may belong to several devices
+        byName = {}
+        for device in fetch_matching('dcim/devices', 'name',
+                                     [element[0] for element in names]):
+            byName.setdefault(device.name, []).append(device)
+        plan = []
+        oldNames = {}
+        ambiguous = []
         for element in names:
-            try:
-                response = nb.dcim.devices.get(name=element[0])
-                print(response.name + ' changed to ' + element[1])
-                response.name = element[1]
-                response.save()
-                print(response.name)
-            except AttributeError:
+            devices = byName.get(element[0], [])
+            if not devices:
                 notfound.append(element[0])
+            elif len(devices) > 1:
+                ambiguous.append((element[0], len(devices)))
+            elif devices[0].name != element[1]:
+                plan.append({'id': devices[0].id, 'name': element[1]})
+                oldNames[devices[0].id] = devices[0].name
+
+        if arguments['dry_run']:
+            for row in plan:
+                print(oldNames[row['id']] + ' would change to ' + row['name'])
+            print('\nDry run: %d devices would be renamed' % len(plan))
+        else:
+            done, errors = bulk_write('PATCH', 'dcim/devices', plan)
+            for row in done:
+                print(oldNames[row['id']] + ' changed to ' + row['name'])
+            if len(errors) > 0:
+                print('\nThese could not be renamed:')
+                for row, message in errors:
+                    print('%s -> %s: %s' % (oldNames[row['id']], row['name'],
+                                            message))
+            elapsed = time.time() - start
+            print('\nRenamed %d of %d devices in %.1fs (%.0f/s)' %
+                  (len(done), len(plan), elapsed,
+                   len(done) / max(elapsed, 0.001)))
+        if len(ambiguous) > 0:
+            print('\nThese name several devices in NetBox and were not '
+                  'renamed:')
+            for name, count in ambiguous:
+                print('%s (%d devices)' % (name, count))
         if len(notfound) > 0:
             print('\nThese were not found in NetBox and could not be renamed:')
             for line in notfound:
@@ -328,78 +2421,193 @@ def change_name(txtfile):
         sys.exit()
 
 
+def print_devices(response):
+    table = Table('device_locate')
+    for device in response:
+        table.row(device.display_name, device.device_type,
+                  device.site.name, device.rack, device.position,
+                  device.asset_tag, device.serial)
+    table.close()
+
+
+def print_prefixes(response):
+    table = Table('prefix')
+    for obj in response:
+        table.row(obj.prefix, obj.status.label, obj.site,
+                  obj.vlan, obj.role, obj.description)
+    table.close()
+
+
+def print_ips(response):
+    table = Table('ip')
+    for ip in response:
+        table.row(ip.address, ip.interface, ip.vrf,
+                  ip.status, '-', ip.description)
+    table.close()
+
+
+def print_vlans(response):
+    table = Table('vlan')
+    for vlan in response:
+        table.row(vlan.display_name, vlan.site.name,
+                  vlan.group, vlan.status, vlan.description)
+    table.close()
+
+
+def print_lines(response):
+    for line in response:
+        print(line)
+
+
+QUERY_SECTIONS = [
+    ('DEVICE', 'dcim/devices', print_devices),
+    ('PREFIXES', 'ipam/prefixes', print_prefixes),
+    ('IP_ADDRESSES', 'ipam/ip-addresses', print_ips),
+    ('VLANS', 'ipam/vlans', print_vlans),
+    ('TENANTS', 'tenancy/tenants', print_lines),
+]
+
+
 def querysearch(query):
-    try:
-        response = nb.dcim.devices.filter(query)
-        print('\nDEVICE')
-        for device in response:
-            print_row7(device.display_name, device.device_type,
-                       device.site.name, device.rack, device.position,
-                       device.asset_tag, device.serial)
+    """Search devices, prefixes, IPs, VLANs and tenants at the same time.
 
-    except AttributeError:
-        pass
-    try:
-        response = nb.ipam.prefixes.filter(query)
-        print('\nPREFIXES')
-        for obj in response:
-            print_row_prefix(obj.prefix, obj.status.label, obj.site,
-                             obj.vlan, obj.role, obj.description)
-    except AttributeError:
-        pass
-    try:
-        response = nb.ipam.ip_addresses.filter(query)
-        print('\nIP_ADDRESSES')
-        for ip in response:
-            print_row_ip(ip.address, ip.interface, ip.vrf,
-                         ip.status, '-', ip.description)
-    except AttributeError:
-        pass
-    try:
-        response = nb.ipam.vlans.filter(query)
-        print('\nVLANS')
-        for vlan in response:
-            print_row_vlan(vlan.display_name, vlan.site.name,
-                           vlan.group, vlan.status, vlan.description)
-    except AttributeError:
-        pass
+    Each section is printed as soon as its search comes back; sections still
+    running after --timeout seconds are reported and skipped.
+    """
+    results = queue.Queue()
+
+    def search(section):
+        try:
+            found = [Record(obj) for obj in
+                     fetch_pages(section[1], {'q': query})]
+            results.put((section, found, None))
+        except Exception as error:
+            results.put((section, None, error))
+
+    pool = thread_pool(len(QUERY_SECTIONS))
     try:
-        response = nb.tenancy.tenants.filter(query)
-        print('\nTENANTS')
-        for line in response:
-            print(line)
-    except AttributeError:
-        pass
+        for section in QUERY_SECTIONS:
+            pool.apply_async(search, (section,))
+        deadline = None
+        if arguments.get('timeout'):
+            deadline = time.time() + arguments['timeout']
+        pending = set(title for title, path, printer in QUERY_SECTIONS)
+        while pending:
+            if deadline is None:
+                # a plain get() would not see Ctrl-C under python 2
+                wait = 3600
+            else:
+                wait = deadline - time.time()
+            try:
+                (title, path, printer), found, error = results.get(
+                    timeout=max(wait, 0))
+            except queue.Empty:
+                for title in sorted(pending):
+                    print('\n%s\ntimed out' % title)
+                break
+            pending.discard(title)
+            print('\n' + title)
+            if error is not None:
+                print('search failed: %s' % error)
+                continue
+            try:
+                printer(found)
+            except AttributeError:
+                pass
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print('\nExiting...')
+        sys.exit()
+    finally:
+        pool.terminate()
 
 
 # =============================
+def deletion_name(kind, obj):
+    """Return obj as -a delete lists it, with its site or VRF."""
+    if kind == 'ip':
+        vrf = getattr(obj, 'vrf', None)
+        return '%s (VRF %s)' % (obj.address, vrf or 'Global')
+    return '%s (site %s)' % (obj.name, getattr(obj, 'site', None) or '-')
+
+
 def object_delete():
     """Bulk delete objects in netbox by device name or ip.
-    Needs testing - AND CONFIRMATION
-    """
-    try:
-        if prompt('ARE YOU SURE YOU WANT TO DELETE EVERYTHING IN ' +
-                  arguments['file'] + '?'):
-            csvname = arguments['file']
-            objectsToDelete = arguments['delete']
-            with open(csvname) as file:
-                lines = [line.strip() for line in file]
-
-            if objectsToDelete == 'device':
-                for line in lines:
-                    response = nb.dcim.devices.get(name=line)
-                    response.delete
-                    print line + ' deleted from NetBox'
-            elif objectsToDelete == 'ip':
-                for line in lines:
-                    response = nb.ipam.ip_addresses.get(name=line)
-                    response.delete
-                    print line + ' deleted from NetBox'
 
-            else:
-                print "\nSpecify object type to delete"
-        else:
+    Everything in the file is looked up in chunked queries, confirmed once
+    with the objects and their count and then deleted in concurrent bulk
+    DELETE batches.  A line deletes one object: an IP with a mask only
+    matches that mask, and a line that matches several objects (a name used
+    at several sites, an address in several VRFs) deletes nothing.
+    """
+    try:
+        objectsToDelete = arguments['type']
+        if objectsToDelete not in ('device', 'ip'):
+            print "\nSpecify object type to delete: -t device or -t ip"
+            return
+        if arguments['file'] is None:
+            print('Error: File required with one ' + objectsToDelete +
+                  ' per line')
+            return
+        path, field, keys, columns = RECONCILE[objectsToDelete]
+        lines = read_lines(arguments['file'])
+        objects = fetch_matching(path, field,
+                                 lookup_keys(objectsToDelete, lines))
+        both, notfound, unused = reconcile(
+            lines, objects, line_index(objectsToDelete, objects))
+        targets = []
+        ambiguous = []
+        seen = set()
+        for line, objs in both:
+            if objectsToDelete == 'ip' and '/' in line:
+                # the index matches hosts, a mask given has to match too
+                objs = [obj for obj in objs
+                        if parse_ip(obj.address) == parse_ip(line)]
+            if not objs:
+                notfound.append(line)
+            elif len(objs) > 1:
+                ambiguous.append((line, objs))
+            elif objs[0].id not in seen:
+                seen.add(objs[0].id)
+                targets.append({'id': objs[0].id, 'line': line,
+                                'name': deletion_name(objectsToDelete,
+                                                      objs[0])})
+
+        for row in targets:
+            print('%s: %s will be deleted from NetBox' %
+                  (row['line'], row['name']))
+        if len(ambiguous) > 0:
+            print('\nThese match several objects in NetBox and were '
+                  'skipped:')
+            for line, objs in ambiguous:
+                print('%s: %s' % (line, ', '.join(
+                    deletion_name(objectsToDelete, obj) for obj in objs)))
+        if len(notfound) > 0:
+            print('\nThese were not found in NetBox:')
+            for line in notfound:
+                print(line)
+        print('\n%d %s objects to delete, %d lines ambiguous, '
+              '%d lines not found' % (len(targets), objectsToDelete,
+                                      len(ambiguous), len(notfound)))
+        if not targets or arguments['dry_run']:
+            return
+        if not prompt('ARE YOU SURE YOU WANT TO DELETE THESE %d %s OBJECTS?' %
+                      (len(targets), objectsToDelete.upper())):
             print('User did not confirm delete')
+            return
+
+        start = time.time()
+        done, errors = bulk_write('DELETE', path,
+                                  [{'id': row['id']} for row in targets])
+        lineById = dict((row['id'], row['line']) for row in targets)
+        if len(errors) > 0:
+            print('\nThese could not be deleted:')
+            for row, message in errors:
+                print('%s: %s' % (lineById[row['id']], message))
+        print('\nDeleted %d of %d objects in %.1fs' %
+              (len(done), len(targets), time.time() - start))
+    except IOError:
+        print('\nFile does not exist')
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -409,16 +2617,15 @@ def object_delete():
 def device_list():
     """Print asset_tag info for each device in netbox."""
     try:
-        response = nb.dcim.devices.all()
-        if arguments['headers']:
-            print '\n'
-            print_row6('NAME', 'PRIMARY IP', 'MODEL',
-                       'STATUS', 'SERIAL', 'ASSET TAG')
-            print 120 * '-'
+        response = iter_all('dcim/devices', (
+            'display_name', 'primary_ip', 'device_type', 'status', 'serial',
+            'asset_tag'))
+        table = Table('device')
         for device in response:
-            print_row6(
+            table.row(
                 device.display_name, device.primary_ip, device.device_type,
                 device.status, device.serial, device.asset_tag)
+        table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -431,16 +2638,15 @@ def device_locate():
     Could be more useful if you could search for the specific device you want
     """
     try:
-        response = nb.dcim.devices.all()
-        if arguments['headers']:
-            print '\n'
-            print_row7('NAME', 'MODEL', 'SITE', 'RACK',
-                       'RACK LOCATION', 'ASSET TAG', 'SN')
-            print 130 * '-'
+        response = iter_all('dcim/devices', (
+            'display_name', 'device_type', 'site.name', 'rack', 'position',
+            'asset_tag', 'serial'))
+        table = Table('device_locate')
         for device in response:
-            print_row7(device.display_name, device.device_type,
-                       device.site.name, device.rack, device.position,
-                       device.asset_tag, device.serial)
+            table.row(device.display_name, device.device_type,
+                      device.site_name, device.rack, device.position,
+                      device.asset_tag, device.serial)
+        table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -450,29 +2656,22 @@ def device_locate():
 def cereal():
     """Print serial number and Device name info for each device in NetBox."""
     try:
-        response = nb.dcim.devices.all()
         if (arguments['file'] is None):
+            response = iter_all('dcim/devices', ('serial', 'display_name'))
+            table = Table('serial')
             for device in response:
-                print_row2(device.serial, device.display_name)
+                table.row(device.serial, device.display_name)
+            table.close()
         else:
-            with open(arguments['file']) as file:
-                lines = [line.strip() for line in file]
-
-            string_list = [str(item.serial) for item in response]
-            strip_list = [item.strip() for item in string_list]
-            a = set(lines)
-            b = set(strip_list)
-            common = a.intersection(b)
-            notInSetB = a.difference(b)
-
-            # print str(strip_list)
-            # print str(arguments['reverse'])
-            if arguments['reverse']:    # show items NOT in NetBox
-                for line in notInSetB:
-                    print_row1(line)
+            table = Table('line')
+            if arguments['diff']:
+                diff_file('serial')
+            elif arguments['reverse']:    # show items NOT in NetBox
+                report_file('serial', fileonly=table.row, table=table)
             else:                       # show items IN NetBox
-                for line in common:
-                    print_row1(line)
+                report_file('serial',
+                            both=lambda line, devices: table.row(line))
+            table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -483,13 +2682,18 @@ def cerealsearch():
         notfound = []
         with open(arguments['file']) as file:
             lines = [line.strip() for line in file]
+        bySerial = {}
+        for device in fetch_matching('dcim/devices', 'serial', lines, (
+                'serial', 'display_name', 'device_type.model', 'site')):
+            bySerial.setdefault(device.serial, []).append(device)
+        table = Table('serial_locate')
         for inputserial in lines:
-            try:
-                response = nb.dcim.devices.get(serial=inputserial)
-                print_row4(response.serial, response.display_name,
-                           response.device_type.model, response.site)
-            except AttributeError:
+            if inputserial not in bySerial:
                 notfound.append(inputserial)
+            for response in bySerial.get(inputserial, []):
+                table.row(response.serial, response.display_name,
+                          response.device_type_model, response.site)
+        table.close()
 
         print('\nNot Found in NetBox:')
         for line in notfound:
@@ -504,18 +2708,15 @@ def cerealsearch():
 def eyepee():
     # ip - list returns IP, VLAN, device, interface, status, description
     try:
-        response = nb.ipam.ip_addresses.all()
-        if arguments['headers']:
-            print_row_ip('IP_ADDRESS', 'INTERFACE', 'DEVICE',
-                         'STATUS', 'VLAN', 'DESCRIPTION')
-            print 120 * '-'
+        response = iter_all('ipam/ip-addresses', (
+            'address', 'interface', 'interface.device.name', 'status',
+            'description'))
+        table = Table('ip')
         for ip in response:
-            try:
-                print_row_ip(ip, ip.interface, ip.interface.device.name,
-                             ip.status, '-', ip.description)
-            except AttributeError:
-                print_row_ip(ip, ip.interface, 'N/A',
-                             ip.status, '-', ip.description)
+            table.row(ip.address, ip.interface,
+                      ip.interface_device_name or 'N/A',
+                      ip.status, '-', ip.description)
+        table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -525,42 +2726,59 @@ def eyepee():
 def veelan():
     # vlan - vlan, site, prefix, status, description
     try:
-        response = nb.ipam.prefixes.all()
-        if arguments['headers']:
-            print_row_vlan('VLAN', 'SITE', 'PREFIX', 'STATUS', 'DESCRIPTION')
-            print 120 * '-'
+        response = iter_all('ipam/prefixes', ('prefix', 'vlan.id'))
+        vlans = related('ipam/vlans')
+        table = Table('vlan', footer=True)
         for prefixes in response:
             try:
-                vlanid = prefixes.vlan.id
-                vlanresponse = nb.ipam.vlans.get(vlanid)
-                print_row_vlan(
+                vlanresponse = vlans[prefixes.vlan_id]
+                table.row(
                     vlanresponse.display_name,
                     vlanresponse.site.name,
-                    prefixes, vlanresponse.status.label,
+                    prefixes.prefix, vlanresponse.status.label,
                     vlanresponse.description)
-            except AttributeError:
+            except (AttributeError, KeyError):
                 pass
-        print 120 * '-'
+        table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
 
 
-def sircut():
-    """Return ID, Type, Provider, A Side, Z Side, Description.
+CIRCUIT_END_COLUMNS = ('circuit.id', 'term_side', 'site.name',
+                       'connected_endpoint.device.name',
+                       'connected_endpoint.name')
 
-    TODO: Implement a cross reference between circuit and circuit terminations
+
+def circuit_ends():
+    """Return {circuit id: {'A': end, 'Z': end}} for all circuits.
+
+    An end is 'SITE DEVICE:INTERFACE', or just the site when nothing is
+    connected.  Every termination comes in one listing and is joined to its
+    circuit here, rather than asking NetBox for each circuit's terminations.
     """
+    ends = {}
+    for end in iter_all('circuits/circuit-terminations', CIRCUIT_END_COLUMNS):
+        text = end.site_name or '-'
+        if end.connected_endpoint_device_name:
+            text = '%s %s:%s' % (text, end.connected_endpoint_device_name,
+                                 end.connected_endpoint_name)
+        ends.setdefault(end.circuit_id, {})[end.term_side] = text
+    return ends
+
+
+def sircut():
+    """Return ID, Type, Provider, A Side, Z Side, Description."""
     try:
-        response = nb.circuits.circuits.all()
-        if arguments['headers']:
-            print_row6('ID', 'TYPE', 'PROVIDER',
-                       'A-SIDE', 'Z-SIDE', 'DESCRIPTION')
-            print 120 * '-'
+        ends = circuit_ends()
+        response = iter_all('circuits/circuits',
+                            ('id', 'cid', 'type', 'provider', 'description'))
+        table = Table('circuit', footer=True)
         for obj in response:
-            print_row6(obj.cid, obj.type, obj.provider,
-                       obj.description[:3], '-', obj.description)
-        print 120 * '-'
+            sides = ends.get(obj.id, {})
+            table.row(obj.cid, obj.type, obj.provider, sides.get('A', '-'),
+                      sides.get('Z', '-'), obj.description)
+        table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -569,13 +2787,11 @@ def sircut():
 def rack():
     """Return name, site, role."""
     try:
-        response = nb.dcim.racks.all()
-        if arguments['headers']:
-            print_row_rack('NAME', 'SITE', 'ROLE')
-            print 120 * '-'
+        response = iter_all('dcim/racks', ('name', 'site.name', 'role'))
+        table = Table('rack', footer=True)
         for obj in response:
-            print_row_rack(obj.name, obj.site.name, obj.role)
-        print 120 * '-'
+            table.row(obj.name, obj.site_name, obj.role)
+        table.close()
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
@@ -584,21 +2800,695 @@ def rack():
 def prefix():
     """Return prefix, status, site, vlan, role, description."""
     try:
-        response = nb.ipam.prefixes.all()
-        if arguments['headers']:
-            print_row_prefix('PREFIX', 'STATUS', 'SITE',
-                             'VLAN', 'ROLE', 'DESCRIPTION')
-            print 120 * '-'
+        response = iter_all('ipam/prefixes', (
+            'prefix', 'status.label', 'site', 'vlan', 'role', 'description'))
+        table = Table('prefix', footer=True)
         for obj in response:
-            print_row_prefix(obj.prefix, obj.status.label, obj.site,
-                             obj.vlan, obj.role, obj.description)
-        print 120 * '-'
+            table.row(obj.prefix, obj.status_label, obj.site,
+                      obj.vlan, obj.role, obj.description)
+        table.close()
+    except KeyboardInterrupt:
+        print('\nExiting...')
+        sys.exit()
+
+
+# ==========================
+# -t interface
+#
+# Interfaces are by far the largest table, so nothing here downloads all of
+# it unless a plain listing asks for it: --device and --site are handed to
+# NetBox as filters and -f checks only ask for the interfaces of the devices
+# in the file, a chunk of devices per request, paged concurrently.
+INTERFACE_COLUMNS = ('device.name', 'name', 'type', 'enabled', 'mac_address',
+                     'description')
+
+
+def interface_filters():
+    """Return the --device and --site filters for dcim/interfaces."""
+    filters = {}
+    if arguments.get('device'):
+        filters['device'] = arguments['device']
+    if arguments.get('site'):
+        filters['site'] = arguments['site']
+    return filters
+
+
+def fetch_interfaces(devices, columns=None):
+    """Return the interfaces of devices, or of --device and --site if given."""
+    filters = interface_filters()
+    if filters:
+        return fetch_all('dcim/interfaces', columns, filters)
+    return fetch_matching('dcim/interfaces', 'device', devices, columns)
+
+
+def interfaces():
+    """List interfaces, or check DEVICE:INTERFACE lines against NetBox."""
+    try:
+        if arguments['file'] is None:
+            response = iter_all('dcim/interfaces', INTERFACE_COLUMNS,
+                                interface_filters())
+            table = Table('interface')
+            for obj in response:
+                table.row(obj.device_name, obj.name, obj.type, obj.enabled,
+                          obj.mac_address, obj.description)
+            table.close()
+        else:
+            table = Table('line')
+            if arguments['diff']:
+                diff_file('interface')
+            elif arguments['reverse']:    # show items NOT in NetBox
+                report_file('interface', fileonly=table.row, table=table)
+            else:                       # show items IN NetBox
+                report_file('interface',
+                            both=lambda line, objs: table.row(line))
+            table.close()
+    except IOError:
+        print('\nFile does not exist')
+    except KeyboardInterrupt:
+        print('\nExiting...')
+        sys.exit()
+
+
+# ==========================
+# -a export
+EXPORT_PATHS = {
+    'device': 'dcim/devices',
+    'serial': 'dcim/devices',
+    'asset': 'dcim/devices',
+    'asset_tag': 'dcim/devices',
+    'ip': 'ipam/ip-addresses',
+    'prefix': 'ipam/prefixes',
+    'vlan': 'ipam/vlans',
+    'rack': 'dcim/racks',
+    'circuit': 'circuits/circuits',
+    'interface': 'dcim/interfaces',
+}
+
+EXPORT_COLUMNS = {
+    'device': ['name', 'device_type', 'site', 'rack', 'position', 'status',
+               'serial', 'asset_tag', 'primary_ip'],
+    'serial': ['serial', 'name'],
+    'asset': ['asset_tag', 'name'],
+    'asset_tag': ['asset_tag', 'name'],
+    'ip': ['address', 'vrf', 'status', 'interface.device', 'interface',
+           'description'],
+    'prefix': ['prefix', 'status', 'site', 'vlan', 'role', 'description'],
+    'vlan': ['vid', 'name', 'site', 'group', 'status', 'description'],
+    'rack': ['name', 'site', 'role'],
+    'circuit': ['cid', 'type', 'provider', 'description'],
+    'interface': ['device', 'name', 'type', 'enabled', 'mtu', 'mac_address',
+                  'lag', 'description'],
+}
+
+EXPORT_CHUNK = 1000     # rows formatted and written at a time
+EXPORT_BUFFER = 1 << 20
+
+
+def export_value(value):
+    """Flatten a row value for export, lists become comma separated."""
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ','.join(export_value(item) for item in value)
+    return value
+
+
+def export():
+    """Stream every object of -t TYPE as CSV or JSON lines."""
+    kind = arguments['type']
+    columns = arguments['columns']
+    if columns:
+        columns = [column.strip() for column in columns.split(',')]
+    elif arguments['format'] == 'csv':
+        columns = EXPORT_COLUMNS[kind]
+    filename = arguments['output']
+    try:
+        if filename is None:
+            raw = sys.stdout
+        else:
+            raw = open(filename, 'wb', EXPORT_BUFFER)
+        out = raw
+        if arguments['gzip'] or (filename or '').endswith('.gz'):
+            out = gzip.GzipFile(fileobj=raw, mode='wb')
+
+        filters = interface_filters() if kind == 'interface' else None
+        if columns:
+            objects = iter_all(EXPORT_PATHS[kind], columns, filters)
+        else:
+            # the whole object, config_context and all: no projection and
+            # no EXCLUDE_FIELDS, so not the shared tables of a manifest
+            objects = (Record(obj) for obj in
+                       iter_objects(EXPORT_PATHS[kind], {}, filters))
+        if arguments['format'] == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(columns)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(objects, EXPORT_CHUNK))
+            if not chunk:
+                break
+            count += len(chunk)
+            if arguments['format'] == 'csv':
+                writer.writerows(
+                    [('%s' % export_value(value)).encode('utf-8')
+                     for value in row] for row in chunk)
+            elif columns:
+                out.write(''.join(json.dumps(dict(
+                    zip(columns, [export_value(value) for value in row]))
+                    ) + '\n' for row in chunk))
+            else:
+                out.write(''.join(json.dumps(obj._values) + '\n'
+                                  for obj in chunk))
+        if out is not raw:
+            out.close()     # GzipFile leaves raw open
+        if raw is sys.stdout:
+            raw.flush()
+        else:
+            raw.close()
+            sys.stderr.write('%d objects exported to %s\n' % (count, filename))
+    except IOError as error:
+        print('\nCould not write export: %s' % error)
     except KeyboardInterrupt:
         print('\nExiting...')
         sys.exit()
 
 
+# ==========================
+# --manifest
+#
+# A manifest lists checks, each a set of the usual options:
+#
+#   checks:
+#     - {type: device, file: devices.txt, reverse: true}
+#     - {type: serial, file: serials.txt, diff: true}
+#     - {type: vlan}
+#
+# The checks run concurrently, each in a thread with its own arguments
+# (Arguments.local) and its own stdout buffer (ThreadOutput), and their
+# output is printed in manifest order.  Whole tables and the indexes built
+# over them are shared (once()), so devices are downloaded once however
+# many checks use them.
+MANIFEST_KEYS = ('name', 'type', 'action', 'file', 'reverse', 'diff',
+                 'headers', 'query', 'columns', 'format', 'output', 'gzip',
+                 'device', 'site', 'external', 'normalize', 'suggest',
+                 'tsv')
+MANIFEST_ACTIONS = ('list', 'export', 'locate')   # nothing that writes
+
+
+class ThreadOutput(object):
+    """A sys.stdout that sends what each thread prints to its own buffer."""
+
+    def __init__(self, out):
+        self.out = out
+        self.local = threading.local()
+
+    # the print statement keeps its state here, it must not leak between
+    # threads printing at the same time
+    @property
+    def softspace(self):
+        return getattr(self.local, 'softspace', 0)
+
+    @softspace.setter
+    def softspace(self, value):
+        self.local.softspace = value
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def write(self, text):
+        (getattr(self.local, 'buffer', None) or self.out).write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
+
+def read_config(filename):
+    """Return the data of a YAML (.yml, .yaml) or JSON file.
+
+    Raises ValueError when it cannot be read.
+    """
+    with open(filename) as f:
+        text = f.read()
+    if filename.endswith(('.yml', '.yaml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('YAML files need PyYAML (pip install pyyaml)'
+                             ', or write %s as JSON' % filename)
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def load_manifest(filename):
+    """Return the checks of a manifest as argument dicts.
+
+    Raises ValueError for a manifest nbcli cannot run.
+    """
+    data = read_config(filename)
+    if isinstance(data, dict):
+        data = data.get('checks')
+    if not isinstance(data, list) or not data:
+        raise ValueError('%s: expected a list of checks' % filename)
+    base = os.path.dirname(os.path.abspath(filename))
+    checks = []
+    for number, check in enumerate(data, 1):
+        if not isinstance(check, dict) or 'type' not in check:
+            raise ValueError('%s: check %d has no type' % (filename, number))
+        unknown = sorted(set(check) - set(MANIFEST_KEYS))
+        if unknown:
+            raise ValueError('%s: check %d: unknown %s' %
+                             (filename, number, ', '.join(unknown)))
+        check = dict({'action': 'list', 'file': None, 'reverse': False,
+                      'diff': False, 'query': None, 'output': None},
+                     **check)
+        if check['action'] not in MANIFEST_ACTIONS:
+            raise ValueError('%s: check %d: -a %s cannot run from a manifest'
+                             % (filename, number, check['action']))
+        for key in ('file', 'output'):    # relative to the manifest
+            if check[key]:
+                check[key] = os.path.join(base, check[key])
+        for key in ('device', 'site'):
+            if isinstance(check.get(key), basestring):
+                check[key] = [check[key]]
+        try:
+            check['normalize'] = normalize_rules(check.get('normalize'))
+        except ValueError as error:
+            raise ValueError('%s: check %d: %s' % (filename, number, error))
+        if check.get('suggest') is True:
+            check['suggest'] = 3
+        checks.append(check)
+    return checks
+
+
+def check_title(number, check):
+    """Return the header line printed above the output of a check."""
+    if check.get('name'):
+        return '# %d: %s' % (number, check['name'])
+    words = ['-t', check['type'], '-a', check['action']]
+    if check['file']:
+        words += ['-f', os.path.basename(check['file'])]
+    for flag in ('reverse', 'diff'):
+        if check[flag]:
+            words.append('--' + flag)
+    return '# %d: %s' % (number, ' '.join(words))
+
+
+def run_check(check, output, buffer):
+    """Run dispatch() with the arguments check in this thread.
+
+    What it prints goes to buffer (output is sys.stdout, a ThreadOutput).
+    Returns the exit status.
+    """
+    output.capture(buffer)
+    arguments.local.values = check
+    status = 0
+    try:
+        dispatch()
+    except SystemExit as exit:
+        if exit.code not in (None, 0):
+            status = exit.code if isinstance(exit.code, int) else 1
+    except Exception as error:
+        logger.debug(lineno() + ': ' + repr(error))
+        buffer.write('Error: %s\n' % error)
+        status = 1
+    finally:
+        arguments.local.values = None
+        output.capture(None)
+    return status
+
+
+def run_manifest(filename):
+    """Run the checks of a manifest concurrently, print them in order."""
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    try:
+        checks = load_manifest(filename)
+    except (IOError, ValueError) as error:
+        print 'Error: %s' % error
+        sys.exit(1)
+    output = ThreadOutput(sys.stdout)
+
+    def run(check):
+        buffer = StringIO()
+        failed = run_check(check, output, buffer) != 0
+        return buffer.getvalue(), failed
+
+    sys.stdout = output
+    failures = 0
+    try:
+        with worker_pool(len(checks)) as pool:
+            for number, (check, (text, failed)) in enumerate(
+                    zip(checks, pool.imap(run, checks)), 1):
+                output.out.write(check_title(number, check) + '\n')
+                output.out.write(text)
+                if not text.endswith('\n'):
+                    output.out.write('\n')
+                output.out.flush()
+                failures += failed
+    finally:
+        sys.stdout = output.out
+    if failures:
+        sys.exit(1)
+
+
+# ==========================
+# --instance
+#
+# Several NetBoxes, each named in the instances file with its URL and token.
+# The read-only actions run against all of them at the same time, each in a
+# thread of its own talking to its Instance (run_check()), and the output of
+# each is printed under its name, with table rows tagged by it.  --match
+# instead answers -f checks once for them all: any counts a line as in
+# NetBox when any instance has it, which lists the instances of every line.
+fanout = False          # several instances, each printing its own output
+matching = []           # the instances of --match
+
+
+def select_instances(names):
+    """Return the Instances named by --instance, in the order given.
+
+    Raises ValueError for a name that is not configured.
+    """
+    configured = load_instances()
+    selected = []
+    for value in names:
+        for name in [name.strip() for name in value.split(',')]:
+            if name == 'all':
+                sites = [configured[key] for key in sorted(configured)]
+            elif name in configured:
+                sites = [configured[name]]
+            elif not name:
+                continue
+            else:
+                raise ValueError('no NetBox instance %s, there are: %s' %
+                                 (name, ', '.join(sorted(configured))))
+            selected.extend(site for site in sites if site not in selected)
+    if not selected:
+        raise ValueError('--instance names no NetBox instance')
+    return selected
+
+
+def instance_output(filename, name):
+    """Return the -o file of instance name: ips.csv.gz is ips.emea.csv.gz."""
+    directory, base = os.path.split(filename)
+    stem, dot, extensions = base.partition('.')
+    return os.path.join(directory, stem + '.' + name + dot + extensions)
+
+
+def report_which(kind):
+    """Print every line of the -f file with the --match instances it is in.
+
+    With -r only the lines that some instance does not have.
+    """
+    table = Table('where')
+    lines = read_lines(arguments['file'])
+    for line, names in check_instances(kind, lines)[3]:
+        if arguments['reverse'] and len(names) == len(matching):
+            continue
+        table.row(line, ','.join(names) or '-')
+    table.close()
+
+
+def run_instances(names):
+    """Run the command line against the --instance NetBoxes."""
+    global fanout, matching
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    try:
+        sites = select_instances(names)
+    except (IOError, ValueError) as error:
+        print 'Error: %s' % error
+        sys.exit(1)
+    if arguments['match']:
+        if not arguments['file'] or arguments['type'] not in RECONCILE or \
+                arguments['action'] != 'list':
+            print('Error: --match is for -a list -f checks of -t ' +
+                  ', '.join(sorted(RECONCILE)))
+            sys.exit(1)
+        matching = sites
+        use_instance(sites[0])  # for the rest, like the prefixes of -t ip
+        if arguments['match'] == 'which':
+            report_which(arguments['type'])
+        else:
+            dispatch()
+        return
+    if len(sites) == 1:
+        use_instance(sites[0])
+        dispatch()
+        return
+    if arguments['query'] is None and \
+            arguments['action'] not in MANIFEST_ACTIONS:
+        print('Error: -a %s runs against one --instance at a time' %
+              arguments['action'])
+        sys.exit(1)
+    fanout = True
+    output = ThreadOutput(sys.stdout)
+
+    def run(site):
+        buffer = StringIO()
+        check = {}
+        if arguments['output']:
+            check['output'] = instance_output(arguments['output'], site.name)
+        with using(site):
+            failed = run_check(check, output, buffer) != 0
+        return buffer.getvalue(), failed
+
+    pool = thread_pool(len(sites))
+    sys.stdout = output
+    failures = 0
+    try:
+        for site, (text, failed) in zip(sites, pool.imap(run, sites)):
+            output.out.write('# %s: %s\n' % (site.name, site.url))
+            output.out.write(text)
+            if text and not text.endswith('\n'):
+                output.out.write('\n')
+            output.out.flush()
+            failures += failed
+    finally:
+        pool.terminate()
+        sys.stdout = output.out
+    if failures:
+        sys.exit(1)
+
+
+# ==========================
+# nbcli serve
+#
+# A daemon that keeps the tables and indexes of a --manifest run in memory
+# and answers the read-only actions (-q, list, locate, export) of other nbcli
+# processes over a Unix socket.  The client sends its parsed arguments as a
+# JSON line; the daemon runs them in a thread of its own (run_check()) and
+# streams back what they print, then a NUL and the exit status.  A thread
+# refreshes the tables every --refresh-interval, when the change log says
+# something changed, and swaps the new ones in.
+#
+# Without a daemon, or for anything that writes, asks or reports --stats,
+# nbcli does the work itself as before.
+SOCKET = os.environ.get('NBCLI_SOCKET',
+                        os.path.join(CACHE_DIR, 'serve.sock'))
+REFRESH_INTERVAL = 300  # seconds between refreshes of the daemon's tables
+SERVE_WARM = ('device', 'serial', 'asset', 'ip')   # indexed at startup
+DECLINED = 'declined'   # status of a request the daemon will not run
+
+
+def daemon_can_run(request):
+    """Return whether nbcli serve may answer request, a dict of arguments.
+
+    Only queries and the read-only MANIFEST_ACTIONS qualify, nothing that
+    writes or prompts, and nothing that has to see NetBox itself.
+    """
+    if request.get('query') is None and \
+            request.get('action') not in MANIFEST_ACTIONS:
+        return False
+    return not (request.get('manifest') or request.get('stats') or
+                request.get('no_cache') or request.get('refresh'))
+
+
+def forward():
+    """Run the command line in nbcli serve, if one is running.
+
+    Returns the exit status, or None when nbcli has to do it itself.
+    """
+    if arguments['no_daemon'] or not hasattr(socket, 'AF_UNIX'):
+        return None
+    if not daemon_can_run(arguments):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(arguments['socket'])
+    except socket.error:
+        client.close()
+        return None
+    request = dict(arguments, netbox=NETBOX)
+    for key in ('file', 'output'):  # the daemon runs elsewhere
+        if request[key]:
+            request[key] = os.path.abspath(request[key])
+    logger.debug(lineno() + ': forwarding to ' + arguments['socket'])
+    trailer = None
+    try:
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        while True:
+            data = client.recv(1 << 16)
+            if not data:
+                break
+            if trailer is None:
+                text, nul, rest = data.partition(b'\0')
+                sys.stdout.write(text)
+                if nul:
+                    trailer = rest
+            else:
+                trailer += data
+    except socket.error:
+        trailer = None
+    finally:
+        client.close()
+    if trailer is None:
+        print 'Error: nbcli serve closed the connection'
+        return 1
+    if trailer == DECLINED:
+        return None
+    return int(trailer)
+
+
+def refresh_tables(newest):
+    """Refresh the daemon's tables if the change log moved past newest.
+
+    Returns the newest change-log time to compare with next time.
+    """
+    global stats
+    times = changelog_times()
+    if times is not None and times[1] == newest:
+        return newest
+    with memo_lock:
+        keys = [key for key in instance().memo if isinstance(key, tuple)]
+    arguments.local.values = {'refresh': True}
+    try:
+        tables = {}
+        for key in keys:
+            if key[0] == 'table':
+                tables[key] = {'lock': threading.Lock(), 'value': [
+                    json.dumps(obj) for obj in iter_objects(
+                        key[1], listing_params(key[1]))]}
+    finally:
+        arguments.local.values = None
+    with memo_lock:
+        instance().memo = tables
+    stats = Stats()     # nobody reads them, do not let them grow
+    for key in keys:    # rebuild what was indexed before
+        if key[0] == 'index':
+            once(key, lambda: table_index(*key[1:]))
+        elif key == ('prefixes',):
+            prefix_index()
+    logger.debug(lineno() + ': refreshed ' + str(len(tables)) + ' tables')
+    return times and times[1]
+
+
+def serve():
+    """Answer the read-only actions of other nbcli processes until killed."""
+    global serving
+    try:
+        import SocketServer as socketserver
+    except ImportError:
+        import socketserver
+    path = arguments['socket']
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            os.remove(path)     # left behind by a daemon that died
+        else:
+            print 'Error: nbcli serve is already running on %s' % path
+            sys.exit(1)
+        finally:
+            probe.close()
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    serving = True
+    # a client that hangs up early (nbcli ... | head) is a socket.error in
+    # its handler, not a SIGPIPE that kills the daemon
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+
+    class Handler(socketserver.StreamRequestHandler):
+        wbufsize = 1 << 16
+
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return  # a probe, see below
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                request = None
+            # forward() declines the same, but not every client is nbcli
+            if not isinstance(request, dict) or \
+                    request.pop('netbox', None) != NETBOX or \
+                    not daemon_can_run(request):
+                self.wfile.write(b'\0' + DECLINED)
+                return
+            try:
+                status = run_check(request, output, self.wfile)
+                self.wfile.write(b'\0%d' % status)
+            except socket.error:
+                pass    # the client went away
+
+        def finish(self):
+            try:
+                socketserver.StreamRequestHandler.finish(self)
+            except socket.error:
+                pass
+
+    class Server(socketserver.ThreadingMixIn,
+                 socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    umask = os.umask(0o077)     # only this user may connect
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+
+    def refresh():
+        newest = None
+        try:
+            times = changelog_times()
+            newest = times and times[1]
+            for kind in SERVE_WARM:
+                once(('index', kind, ()), lambda: table_index(kind))
+            prefix_index()
+        except Exception as error:
+            sys.stderr.write('nbcli serve: warming up failed: %s\n' % error)
+        interval = arguments['refresh_interval'] or REFRESH_INTERVAL
+        while True:
+            time.sleep(interval)
+            try:
+                newest = refresh_tables(newest)
+            except Exception as error:
+                sys.stderr.write('nbcli serve: refresh failed: %s\n' % error)
+
+    refresher = threading.Thread(target=refresh)
+    refresher.daemon = True
+    refresher.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    output.out.write('nbcli serve: %s on %s\n' % (NETBOX, path))
+    output.out.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
 def prompt(query):
+    from distutils.util import strtobool
     sys.stdout.write('%s [YES / NO]: ' % query)
     val = raw_input()
     try:
@@ -610,29 +3500,8 @@ def prompt(query):
 
 
 # =======================
-if __name__ == "__main__":
-    argparser = argparse.ArgumentParser(
-        formatter_class=RawTextHelpFormatter,
-        prog='nbcli',
-        usage='%(prog)s [options]',
-        description='A NetBox CLI tool useful for bulk actions and comparison',
-        epilog="""Examples:\nnbcli -a list -t device -f mydevices.txt
-Show all the devices in mydevices.txt that ARE in NetBox.
-
-nbcli -a list -t device -f mydevices.txt -r
-Show all the devices in mydevices.txt that are NOT in NetBox.
-"""
-    )
-    arguments = ArgParse(argparser)
-    if (arguments['file'] is not None):
-        try:
-            f = open(arguments['file'])
-        except IOError:
-            print 'Error: File "' + arguments['file'] + '" not accessible'
-            sys.exit(1)
-        else:
-            f.close()
-
+def dispatch():
+    """Run the action that -t, -a, -f and -q ask for."""
     # 2017-09-27/DN: Re-doing the if-thens to be more comprehensive.
     # 2017-09-27/DN: Wow. That is giant and messy. I'm 90% sure there's a better
     #       way to do that, I think it involves dictionaries but I'm not
@@ -666,7 +3535,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
                 change_name(arguments['file'])
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             device_locate()
@@ -674,6 +3543,25 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print "Error: unregcognized action: -a", arguments['action']
             sys.exit(1)
 
+    # -t asset
+    elif (arguments['type'] in ('asset', 'asset_tag')):
+        if (arguments['action'] == 'list'):
+            logger.debug(lineno() + ': -t ' + str(arguments))
+            if (arguments['file'] is None):
+                device_list()
+            else:
+                dcim(arguments['file'], arguments['type'],
+                     arguments['reverse'])
+        elif (arguments['action'] == 'export'):
+            logger.debug(lineno() + ': -t ' + str(arguments))
+            export()
+        elif (arguments['action'] in ('delete', 'rename', 'locate')):
+            logger.debug(lineno() + ': -t ' + str(arguments))
+            print 'Not implemented: ' + str(arguments)
+        else:
+            print "Error: unregcognized action: -a", arguments['action']
+            sys.exit(1)
+
     # -t circuit
     elif (arguments['type'] == 'circuit'):
         if (arguments['action'] == 'list'):
@@ -687,7 +3575,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -706,13 +3594,13 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
                      arguments['reverse'])
         elif (arguments['action'] == 'delete'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            object_delete()
         elif (arguments['action'] == 'rename'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -724,7 +3612,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
     elif (arguments['type'] == 'interface'):
         if (arguments['action'] == 'list'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            interfaces()
         elif (arguments['action'] == 'delete'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -733,7 +3621,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -754,7 +3642,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -775,7 +3663,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -796,7 +3684,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             cerealsearch()
@@ -820,7 +3708,7 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
             print 'Not implemented: ' + str(arguments)
         elif (arguments['action'] == 'export'):
             logger.debug(lineno() + ': -t ' + str(arguments))
-            print 'Not implemented: ' + str(arguments)
+            export()
         elif (arguments['action'] == 'locate'):
             logger.debug(lineno() + ': -t ' + str(arguments))
             print 'Not implemented: ' + str(arguments)
@@ -832,3 +3720,47 @@ Show all the devices in mydevices.txt that are NOT in NetBox.
     else:
         print "Error: unregcognized type: -t", arguments['type']
         sys.exit(1)
+
+
+# =======================
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        formatter_class=RawTextHelpFormatter,
+        prog='nbcli',
+        usage='%(prog)s [options]',
+        description='A NetBox CLI tool useful for bulk actions and comparison',
+        epilog="""Examples:\nnbcli -a list -t device -f mydevices.txt
+Show all the devices in mydevices.txt that ARE in NetBox.
+
+nbcli -a list -t device -f mydevices.txt -r
+Show all the devices in mydevices.txt that are NOT in NetBox.
+"""
+    )
+    arguments = ArgParse(argparser)
+    if arguments['stats']:
+        atexit.register(write_stats)
+    # die quietly when the output is piped into head, grep -m, ...
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    if (arguments['file'] is not None):
+        try:
+            f = open(arguments['file'])
+        except IOError:
+            print 'Error: File "' + arguments['file'] + '" not accessible'
+            sys.exit(1)
+        else:
+            f.close()
+
+    if arguments['pager'] and arguments['command'] != 'serve':
+        start_pager()
+    if (arguments['command'] == 'serve'):
+        serve()
+    elif (arguments['manifest'] is not None):
+        run_manifest(arguments['manifest'])
+    elif arguments['instance']:
+        run_instances(arguments['instance'])
+    else:
+        status = forward()
+        if status is None:
+            dispatch()
+        elif status:
+            sys.exit(status)